@@ -2,107 +2,173 @@
 # licence : GPLv2 (see LICENSE.md)
 
 from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QDoubleValidator
 from PyQt5 import QtWidgets
 from qgis.core import *
 from qgis.gui import QgsProjectionSelectionWidget
 from . import tools
+import numpy as np
 import struct
+import math
+import sys
+import os
+import queue
+import threading
+import concurrent.futures
 
-def samepoint(a, b) :
-    return ((a[0] - b[0])**2 + (a[1] - b[1])**2)**0.5 < 1e-8
+def samepoint(a, b, tolerance = 1e-8) :
+    return ((a[0] - b[0])**2 + (a[1] - b[1])**2)**0.5 < tolerance
+
+
+class pointIndex :
+    # hash grid with cells of the size of the snapping tolerance, a point can
+    # only match points stored in its own cell or in the 8 neighbouring ones
+
+    def __init__(self, tolerance) :
+        if not tolerance > 0 :
+            raise ValueError("the snapping tolerance must be positive")
+        self.tolerance = tolerance
+        self.cells = {}
+        # cell of each stored id, a snapped point can be in another cell
+        self.keys = {}
+
+    def cell(self, x) :
+        return (math.floor(x[0] / self.tolerance), math.floor(x[1] / self.tolerance))
+
+    def add(self, x, id) :
+        key = self.cell(x)
+        self.keys[id] = key
+        self.cells.setdefault(key, []).append((x, id))
+
+    def remove(self, id) :
+        key = self.keys.pop(id)
+        cell = self.cells[key]
+        for i, (_, cid) in enumerate(cell) :
+            if cid == id :
+                del cell[i]
+                break
+        if not cell :
+            del self.cells[key]
+
+    def find(self, x) :
+        ci, cj = self.cell(x)
+        for i in (ci - 1, ci, ci + 1) :
+            for j in (cj - 1, cj, cj + 1) :
+                for y, id in self.cells.get((i, j), ()) :
+                    if samepoint(x, y, self.tolerance) :
+                        return id
+        return None
 
 class lineloop :
-    
-    def __init__(self, x0, x1, id0, id1, lids) :
+
+    def __init__(self, x0, x1, id0, id1, lines) :
         self.id = [id0, id1]
         self.x = [x0, x1]
-        self.lines = [(lid, True) for lid in lids]
-    
-    def reverse(self) :
-        self.lines = [(id, not flag) for id, flag in self.lines[::-1]]
-        self.id.reverse()
-        self.x.reverse()
-
-    def merge(self, o) :
-        if self.id[1] == o.id[1] or self.id[0] == o.id[0]:
-            self.reverse()
-        if self.id[1] == o.id[0] :
-            self.id[1] = o.id[1]
-            self.x[1] = o.x[1]
-            self.lines = self.lines + o.lines
-            return True
-        if self.id[0] == o.id[1] :
-            self.id[0] = o.id[0]
-            self.x[0] = o.x[0]
-            self.lines = o.lines + self.lines
-            return True
-        return False
-    
+        self.lines = lines
+
     def closed(self) :
         return self.id[0] == self.id[1]
 
 
-class geoWriter :
+class loopAssembler :
+    # the boundary pieces are only collected while the geometry is exported,
+    # they are joined into line loops at the end by walking the graph of the
+    # pieces sharing an end point, so that each piece is visited once
+
+    def __init__(self) :
+        self.pieces = []
+        self.adjacency = {}
+        self.x = {}
+
+    def add(self, ll) :
+        self.pieces.append(ll)
+        if ll.closed() :
+            return
+        for x, id in zip(ll.x, ll.id) :
+            self.adjacency.setdefault(id, []).append(len(self.pieces) - 1)
+            self.x[id] = x
+
+    def degree(self, id) :
+        return len(self.adjacency.get(id, ()))
 
-    def __init__(self, filename) :
+    def chain(self, ip, id, visited) :
+        lines = []
+        last = ip
+        while ip is not None :
+            visited[ip] = True
+            last = max(last, ip)
+            ll = self.pieces[ip]
+            if ll.id[0] == id :
+                lines.extend(ll.lines)
+                id = ll.id[1]
+            else :
+                lines.extend((lid, not flag) for lid, flag in reversed(ll.lines))
+                id = ll.id[0]
+            ip = next((j for j in self.adjacency[id] if not visited[j]), None)
+        return lines, id, last
+
+    def assemble(self) :
+        """Join the pieces, return the closed line loops in the order in which
+        their last piece was added and the (start, end) coordinates of the
+        chains that cannot be closed."""
+        visited = [False] * len(self.pieces)
+        loops = [None] * len(self.pieces)
+        dangling = []
+        for ip, ll in enumerate(self.pieces) :
+            if ll.closed() :
+                visited[ip] = True
+                loops[ip] = ll
+        for ip, ll in enumerate(self.pieces) :
+            for x, id in zip(ll.x, ll.id) :
+                if not visited[ip] and self.degree(id) == 1 :
+                    _, end, _ = self.chain(ip, id, visited)
+                    dangling.append((x, self.x[end]))
+        for ip, ll in enumerate(self.pieces) :
+            if visited[ip] :
+                continue
+            start = ll.id[0]
+            lines, end, last = self.chain(ip, start, visited)
+            if end == start :
+                loops[last] = lineloop(ll.x[0], ll.x[0], start, start, lines)
+            else :
+                dangling.append((ll.x[0], self.x[end]))
+        return [ll for ll in loops if ll is not None], dangling
+
+
+class geometryWriter :
+    # snap and assemble the exported lines, the entities are written by the
+    # write* methods of the derived classes, which return 0-based ids
+
+    def __init__(self, tolerance = 1e-8) :
+        self.tolerance = tolerance
         self.ip = 0
         self.il = 0
         self.ill = 0
-        self.geof = open(filename, "w")
-        self.geof.write("IP = newp;\n")
-        self.geof.write("IL = newl;\n")
-        self.geof.write("IS = news;\n")
-        self.geof.write("ILL = newll;\n")
+        self.iS = 0
+        self.aborted = False
+        self.dangling = []
         self.physicals = {}
-        self.lineloops = []
+        self.lineloops = loopAssembler()
+        self.endpoints = pointIndex(tolerance)
         self.lineInSurface = []
         self.pointInSurface = []
         self.surfaceInSurface = []
         self.physicalsInnerSurface = {}
 
-    def writePoint(self, pt, lc) :
-        if lc is not None :
-            self.geof.write("Point(IP+%d) = {%.16g, %.16g, 0, %g};\n" %
-                    (self.ip, pt[0], pt[1], lc))
-        else :
-            self.geof.write("Point(IP+%d) = {%.16g, %.16g, 0};\n" %
-                    (self.ip, pt[0], pt[1]))
-        self.ip += 1
-        return self.ip - 1
-
     def writePointCheckLineLoops(self, pt, lc) :
-        for ll in self.lineloops :
-            if samepoint(ll.x[0], pt) :
-                return ll.id[0]
-            if samepoint(ll.x[1], pt) :
-                return ll.id[1]
+        id = self.endpoints.find(pt)
+        if id is not None :
+            return id
         return self.writePoint(pt, lc)
 
-    def writeLine(self, pts) :
-        self.geof.write("Spline(IL+%d) = {IP+" % self.il +
-            ", IP+".join([str(i) for i in pts]) + "};\n")
-        self.il += 1
-        return self.il - 1
-    
-    def writeLineLoop(self, ll) :
-        strid = [("IL+"+str(i)) if o else ("-IL-"+str(i)) for i, o in ll.lines]
-        self.geof.write("Line Loop(ILL+%d) = {" % self.ill +
-            ", ".join(strid) + "};\n")
-        self.ill += 1
-        return self.ill - 1
-
-    def addPointFromCoordInside(self, pt, xform, lc) :
-        if xform :
-            pt = xform.transform(pt)
+    def addPointFromCoordInside(self, pt, lc) :
         id0 = self.writePointCheckLineLoops(pt, lc)
         self.pointInSurface += [id0]
 
-    def addLineFromCoords(self, pts, xform, lc, physical, inside, forceAllBnd) :
-        if xform :
-            pts = [xform.transform(x) for x in pts]
+    def addLineFromCoords(self, pts, lc, physical, inside, forceAllBnd) :
         firstp = self.ip
         id0 = self.writePointCheckLineLoops(pts[0], lc)
-        if samepoint(pts[0], pts[-1]) :
+        if samepoint(pts[0], pts[-1], self.tolerance) :
             id1 = id0
         else :
             id1 = self.writePointCheckLineLoops(pts[-1], lc)
@@ -118,16 +184,12 @@ class geoWriter :
                     self.physicals[physical].append(lid)
                 else :
                     self.physicals[physical] = [lid]
-        ll = lineloop(pts[0], pts[-1], id0, id1, lids)
+        ll = lineloop(pts[0], pts[-1], id0, id1, [(lid, True) for lid in lids])
         if inside and not ll.closed():
                 self.lineInSurface += lids
                 self.pointInSurface += ids
         if not inside or ll.closed() :
-            self.lineloops = [o for o in self.lineloops if not ll.merge(o)]
-            if ll.closed() :
-                self.writeLineLoop(ll)
-            else:
-                self.lineloops.append(ll)
+            self.addBoundaryPiece(ll)
             if inside:
                 if physical :
                     if physical in self.physicalsInnerSurface :
@@ -136,117 +198,664 @@ class geoWriter :
                         self.physicalsInnerSurface[physical] = [len(self.surfaceInSurface)]
                 self.surfaceInSurface.append(ll)
 
-    def setBackgroundField(self, filename) :
-        self.geof.write("NF = newf;\n")
-        self.geof.write("Field[NF] = Structured;\n")
-        self.geof.write("Field[NF].TextFormat = 0;\n")
-        self.geof.write("Field[NF].FileName = \"%s\";\n" % filename)
-        self.geof.write("Background Field = NF;\n")
-
-    def __del__(self) :
-        self.geof.write("Plane Surface(IS) = {ILL:ILL+%d};\n" % (self.ill - 1))
-        self.geof.write("Physical Surface(\"Domain\") = {IS};\n")
-        for iS, innerS in enumerate(self.surfaceInSurface):
-            ill = self.writeLineLoop(innerS)
-            self.geof.write("Plane Surface(IS+%d) = {ILL+%d};\n"%(iS+1,ill))
-        for iS in range(len(self.surfaceInSurface)+1):
-            if self.lineInSurface :
-                self.geof.write("Line {" + ",".join(["IP+%d" % i for i in self.lineInSurface]) + "} In Surface{IS+%d};\n"%(iS))
-            if self.pointInSurface :
-                self.geof.write("Point {" + ",".join(["IL+%d" % i for i in self.pointInSurface]) + "} In Surface{IS+%d};\n"%(iS))
-        print(self.physicalsInnerSurface)
+    def addBoundaryPiece(self, ll) :
+        # an end point shared by two pieces becomes an interior point of a
+        # loop and cannot be snapped to anymore
+        self.lineloops.add(ll)
+        if ll.closed() :
+            return
+        for x, id in zip(ll.x, ll.id) :
+            degree = self.lineloops.degree(id)
+            if degree == 1 :
+                self.endpoints.add(x, id)
+            elif degree == 2 :
+                self.endpoints.remove(id)
+
+    def writeLineLoops(self) :
+        loops, self.dangling = self.lineloops.assemble()
+        for ll in loops :
+            self.writeLineLoop(ll)
+        return self.dangling
+
+    def writeSurfaces(self) :
+        # the boundary line loops have ids 0 to self.ill - 1
+        domain = self.writePlaneSurface(list(range(self.ill)))
+        self.writePhysical(2, "Domain", [domain])
+        surfaces = [domain]
+        for innerS in self.surfaceInSurface :
+            surfaces.append(self.writePlaneSurface([self.writeLineLoop(innerS)]))
+        self.writeInSurface(self.pointInSurface, self.lineInSurface, surfaces)
         for tag, ids in self.physicalsInnerSurface.items() :
-            print(tag,ids)
-            self.geof.write("Physical Surface(\"" + tag + "\") = {" + ",".join(("IS + " + str(i+1)) for i in ids) + "};\n")
+            self.writePhysical(2, tag, [surfaces[i + 1] for i in ids])
         for tag, ids in self.physicals.items() :
-            self.geof.write("Physical Line(\"" + tag + "\") = {" + ",".join(("IL + " + str(i)) for i in ids) + "};\n")
+            self.writePhysical(1, tag, ids)
+
+    def finalize(self) :
+        """Write the surfaces and physical groups, writeLineLoops should
+        have been called before."""
+        self.writeSurfaces()
+
+    def abort(self) :
+        self.aborted = True
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, excType, excValue, traceback) :
+        # the output is only completed if no exception occured
+        if excType is None and not self.aborted :
+            self.finalize()
+        else :
+            self.abort()
+
+
+# number of characters kept in memory before being written to the .geo file
+geoBufferSize = 1 << 20
+
+class geoWriter(geometryWriter) :
+
+    def __init__(self, filename, tolerance = 1e-8) :
+        super(geoWriter, self).__init__(tolerance)
+        # the file is written next to its final location and renamed once
+        # completed, so that an interrupted export never leaves a truncated
+        # .geo file
+        self.filename = filename
+        self.geof = open(filename + ".tmp", "w")
+        self.buffer = []
+        self.bufferSize = 0
+        self.write("IP = newp;\n")
+        self.write("IL = newl;\n")
+        self.write("IS = news;\n")
+        self.write("ILL = newll;\n")
+
+    def write(self, txt) :
+        self.buffer.append(txt)
+        self.bufferSize += len(txt)
+        if self.bufferSize > geoBufferSize :
+            self.flush()
+
+    def flush(self) :
+        self.geof.write("".join(self.buffer))
+        self.buffer = []
+        self.bufferSize = 0
+
+    def writePoint(self, pt, lc) :
+        # repr gives the shortest representation that reads back exactly
+        if lc is not None :
+            self.write("Point(IP+%d) = {%r, %r, 0, %r};\n" %
+                    (self.ip, float(pt[0]), float(pt[1]), float(lc)))
+        else :
+            self.write("Point(IP+%d) = {%r, %r, 0};\n" %
+                    (self.ip, float(pt[0]), float(pt[1])))
+        self.ip += 1
+        return self.ip - 1
+
+    def writeLine(self, pts) :
+        # the interior points of a line are consecutive and written as a range
+        self.write("Spline(IL+%d) = {%s};\n" % (self.il, idList("IP", pts)))
+        self.il += 1
+        return self.il - 1
+    
+    def writeLineLoop(self, ll) :
+        strid = [("IL+"+str(i)) if o else ("-IL-"+str(i)) for i, o in ll.lines]
+        self.write("Line Loop(ILL+%d) = {" % self.ill +
+            ", ".join(strid) + "};\n")
+        self.ill += 1
+        return self.ill - 1
+
+    def writePlaneSurface(self, loops) :
+        self.write("Plane Surface(IS+%d) = {%s};\n" % (self.iS, idList("ILL", loops)))
+        self.iS += 1
+        return self.iS - 1
+
+    def writeInSurface(self, points, lines, surfaces) :
+        lines = "Line {%s} In Surface" % idList("IL", lines) if lines else None
+        points = "Point {%s} In Surface" % idList("IP", points) if points else None
+        for surface in surfaces :
+            if lines :
+                self.write("%s{IS+%d};\n" % (lines, surface))
+            if points :
+                self.write("%s{IS+%d};\n" % (points, surface))
+
+    def writePhysical(self, dim, tag, ids) :
+        prefix = {1 : "IL", 2 : "IS"}[dim]
+        self.write("Physical %s(\"%s\") = {%s};\n" %
+            (["Point", "Line", "Surface"][dim], tag, idList(prefix, ids)))
+
+    def setBackgroundField(self, filename) :
+        self.write("NF = newf;\n")
+        self.write("Field[NF] = Structured;\n")
+        self.write("Field[NF].TextFormat = 0;\n")
+        self.write("Field[NF].FileName = \"%s\";\n" % filename)
+        self.write("Background Field = NF;\n")
+
+    def finalize(self) :
+        super(geoWriter, self).finalize()
+        self.flush()
         self.geof.close()
+        os.replace(self.geof.name, self.filename)
+
+    def abort(self) :
+        super(geoWriter, self).abort()
+        if not self.geof.closed :
+            self.geof.close()
+            os.remove(self.geof.name)
+
+
+def idList(prefix, ids) :
+    # consecutive ids are written as ranges
+    items = []
+    start = 0
+    for i in range(1, len(ids) + 1) :
+        if i < len(ids) and ids[i] == ids[i - 1] + 1 :
+            continue
+        if i - start > 2 :
+            items.append("%s+%d:%s+%d" % (prefix, ids[start], prefix, ids[i - 1]))
+        else :
+            items.extend("%s+%d" % (prefix, id) for id in ids[start:i])
+        start = i
+    return ", ".join(items)
 
 
-def writeRasterLayer(layer, filename) :
-    progress = QtWidgets.QProgressDialog("Writing mesh size layer...", "Abort", 0, layer.width())
-    progress.setMinimumDuration(0)
-    progress.setWindowModality(Qt.WindowModal)
-    progress.setValue(0)
-    f = open(filename, "wb")
+class modelWriter(geometryWriter) :
+    # keep the geometry in memory, to be built with the gmsh python api by
+    # meshModel.py, tags are ids + 1
+
+    def __init__(self, tolerance = 1e-8) :
+        super(modelWriter, self).__init__(tolerance)
+        self.points = []
+        self.splines = []
+        self.loops = []
+        self.surfaces = []
+        self.embedded = ([], [], [])
+        self.physicalGroups = []
+        self.field = None
+        self.model = None
+
+    def writePoint(self, pt, lc) :
+        self.points.append((pt[0], pt[1], 0 if lc is None else lc))
+        self.ip += 1
+        return self.ip - 1
+
+    def writeLine(self, pts) :
+        self.splines.append([i + 1 for i in pts])
+        self.il += 1
+        return self.il - 1
+
+    def writeLineLoop(self, ll) :
+        self.loops.append([(i + 1) if o else -(i + 1) for i, o in ll.lines])
+        self.ill += 1
+        return self.ill - 1
+
+    def writePlaneSurface(self, loops) :
+        self.surfaces.append([i + 1 for i in loops])
+        self.iS += 1
+        return self.iS - 1
+
+    def writeInSurface(self, points, lines, surfaces) :
+        self.embedded = ([i + 1 for i in points], [i + 1 for i in lines], [i + 1 for i in surfaces])
+
+    def writePhysical(self, dim, tag, ids) :
+        self.physicalGroups.append((dim, str(tag), [i + 1 for i in ids]))
+
+    def setBackgroundField(self, filename) :
+        self.field = filename
+
+    def finalize(self) :
+        super(modelWriter, self).finalize()
+        self.model = {
+            "points" : np.array(self.points, np.float64).reshape(-1, 3),
+            "splines" : self.splines,
+            "loops" : self.loops,
+            "surfaces" : self.surfaces,
+            "embedded" : self.embedded,
+            "physicals" : self.physicalGroups,
+            "field" : self.field
+        }
+
+
+rasterDataTypes = {
+    Qgis.Byte : np.uint8,
+    Qgis.UInt16 : np.uint16,
+    Qgis.Int16 : np.int16,
+    Qgis.UInt32 : np.uint32,
+    Qgis.Int32 : np.int32,
+    Qgis.Float32 : np.float32,
+    Qgis.Float64 : np.float64
+}
+
+# maximum number of pixels read at once from the mesh size layer
+rasterTileSize = 1 << 22
+
+def readRasterBlock(provider, extent, width, height) :
+    # nodata pixels and pixels outside of the layer are returned as NaN
+    data = np.full((height, width), np.nan)
+    pw = extent.width() / width
+    ph = extent.height() / height
+    lext = provider.extent()
+    # only read the pixels whose center is inside the layer, so that the
+    # provider never has to flag the pixels outside of it one by one
+    c0 = max(0, math.ceil((lext.xMinimum() - extent.xMinimum()) / pw - 0.5))
+    c1 = min(width, math.floor((lext.xMaximum() - extent.xMinimum()) / pw - 0.5) + 1)
+    r0 = max(0, math.ceil((extent.yMaximum() - lext.yMaximum()) / ph - 0.5))
+    r1 = min(height, math.floor((extent.yMaximum() - lext.yMinimum()) / ph - 0.5) + 1)
+    if c1 <= c0 or r1 <= r0 :
+        return data
+    sub = QgsRectangle(extent.xMinimum() + c0 * pw, extent.yMaximum() - r1 * ph,
+        extent.xMinimum() + c1 * pw, extent.yMaximum() - r0 * ph)
+    block = provider.block(1, sub, c1 - c0, r1 - r0)
+    if block.dataType() not in rasterDataTypes :
+        raise ValueError("unsupported data type of the mesh size layer")
+    v = np.frombuffer(bytes(block.data()), rasterDataTypes[block.dataType()])
+    v = v.reshape(r1 - r0, c1 - c0).astype(np.float64)
+    if block.hasNoDataValue() :
+        v[v == block.noDataValue()] = np.nan
+    for r in provider.userNoDataValues(1) :
+        v[(v >= r.min()) & (v <= r.max())] = np.nan
+    data[r0:r1, c0:c1] = v
+    return data
+
+
+def aggregateMax(v, axis) :
+    v = np.where(np.isnan(v), -np.inf, v).max(axis)
+    v[v == -np.inf] = np.nan
+    return v
+
+def aggregateMin(v, axis) :
+    v = np.where(np.isnan(v), np.inf, v).min(axis)
+    v[v == np.inf] = np.nan
+    return v
+
+def aggregateMean(v, axis) :
+    valid = ~np.isnan(v)
+    with np.errstate(invalid="ignore", divide="ignore") :
+        return np.where(valid, v, 0).sum(axis) / valid.sum(axis)
+
+rasterAggregations = {
+    "min" : aggregateMin,
+    "max" : aggregateMax,
+    "mean" : aggregateMean
+}
+
+
+def rasterGrid(layer, extent, cellSize) :
+    # return the origin, cell size and number of cells of the written field
+    lext = layer.extent()
+    if extent is None or not extent.intersects(lext) :
+        extent = lext
+    else :
+        extent = extent.intersect(lext)
+    if cellSize :
+        nx = max(1, math.ceil(extent.width() / cellSize))
+        ny = max(1, math.ceil(extent.height() / cellSize))
+        return extent.xMinimum(), extent.yMinimum(), cellSize, cellSize, nx, ny
+    # snap on the pixels of the layer
+    dx = lext.width() / layer.width()
+    dy = lext.height() / layer.height()
+    i0 = math.floor((extent.xMinimum() - lext.xMinimum()) / dx + 1e-8)
+    i1 = math.ceil((extent.xMaximum() - lext.xMinimum()) / dx - 1e-8)
+    j0 = math.floor((extent.yMinimum() - lext.yMinimum()) / dy + 1e-8)
+    j1 = math.ceil((extent.yMaximum() - lext.yMinimum()) / dy - 1e-8)
+    return (lext.xMinimum() + i0 * dx, lext.yMinimum() + j0 * dy, dx, dy,
+        max(1, i1 - i0), max(1, j1 - j0))
+
+
+def writeRasterLayer(layer, filename, progress, extent = None, cellSize = None, aggregation = "min", nodataSize = None) :
+    """Write the mesh size layer as a binary gmsh Structured field. If
+    cellSize is given, the part of the layer inside extent is resampled on
+    cells of this size, aggregating the pixels with the min, max or mean
+    function. The nodata cells are set to nodataSize if it is given, and
+    keep the nodata value of the layer (NaN if it has none) otherwise. progress is a tools.taskProgress counting the columns of cells."""
+    x0, y0, dx, dy, nx, ny = rasterGrid(layer, extent, cellSize)
+    # number of pixels sampled along each direction in a resampled cell
     ext = layer.extent()
-    dx = ext.width() / layer.width()
-    dy = ext.height() / layer.height()
-    f.write(struct.pack("3d", ext.xMinimum() + 0.5 * dx, ext.yMinimum() + 0.5 * dy, 0))
-    f.write(struct.pack("3d", dx, dy, 1))
-    f.write(struct.pack("3i", layer.width(), layer.height(), 1))
-    block = layer.dataProvider().block(1, layer.extent(), layer.width(), layer.height())
-    for j in range(layer.width()) : 
-        progress.setValue(j)
-        if progress.wasCanceled():
-            return False
-        v = list([block.value(i, j) for i in range(layer.height() -1, -1, -1)])
-        f.write(struct.pack("{}d".format(len(v)), *v))
-    f.close()
+    k = 1
+    if cellSize :
+        k = max(1, round(cellSize / min(ext.width() / layer.width(), ext.height() / layer.height())))
+    aggregate = rasterAggregations[aggregation]
+    progress.setTotal(nx)
+    provider = layer.dataProvider()
+    fill = nodataSize
+    if fill is None and provider.sourceHasNoDataValue(1) :
+        fill = provider.sourceNoDataValue(1)
+    ncols = max(1, rasterTileSize // (ny * k * k))
+    with open(filename, "wb") as f :
+        f.write(struct.pack("3d", x0 + 0.5 * dx, y0 + 0.5 * dy, 0))
+        f.write(struct.pack("3d", dx, dy, 1))
+        f.write(struct.pack("3i", nx, ny, 1))
+        for i0 in range(0, nx, ncols) :
+            i1 = min(nx, i0 + ncols)
+            if not progress.advance(i1 - i0) :
+                return False
+            tile = QgsRectangle(x0 + i0 * dx, y0, x0 + i1 * dx, y0 + ny * dy)
+            v = readRasterBlock(provider, tile, (i1 - i0) * k, ny * k)
+            if k > 1 :
+                v = aggregate(v.reshape(ny, k, i1 - i0, k), (1, 3))
+            if fill is not None :
+                v[np.isnan(v)] = fill
+            # gmsh reads the values column by column, from the bottom row
+            f.write(v[::-1, :].T.tobytes())
     return True
 
 
-def exportGeo(filename, layers, insideLayers, sizeLayer, crs, forceAllBnd) :
-    nFeatures = sum((layer.featureCount()for layer in layers))
-    progress = QtWidgets.QProgressDialog("Exporting geometry...", "Abort", 0, nFeatures)
-    progress.setMinimumDuration(0)
-    progress.setWindowModality(Qt.WindowModal)
-    geo = geoWriter(filename)
+def layersExtent(layers, crs) :
+    extent = None
+    for layer in layers :
+        xform = QgsCoordinateTransform(layer.crs(), crs, layer.transformContext)
+        lext = xform.transformBoundingBox(layer.extent())
+        if extent is None :
+            extent = lext
+        else :
+            extent.combineExtentWith(lext)
+    return extent
+
+
+class minimumSizeGrid :
+    # coarse grid of the minimum of the mesh size layer, giving a lower bound
+    # of the mesh size around a feature
+
+    def __init__(self, layer, n = 256, k = 4) :
+        self.extent = layer.extent()
+        self.nx = min(n, layer.width())
+        self.ny = min(n, layer.height())
+        v = readRasterBlock(layer.dataProvider(), self.extent, self.nx * k, self.ny * k)
+        # first row at the bottom
+        self.values = aggregateMin(v.reshape(self.ny, k, self.nx, k), (1, 3))[::-1, :]
+
+    def minimum(self, rect) :
+        ext = self.extent
+        i0 = max(0, math.floor((rect.xMinimum() - ext.xMinimum()) / ext.width() * self.nx))
+        i1 = min(self.nx, math.floor((rect.xMaximum() - ext.xMinimum()) / ext.width() * self.nx) + 1)
+        j0 = max(0, math.floor((rect.yMinimum() - ext.yMinimum()) / ext.height() * self.ny))
+        j1 = min(self.ny, math.floor((rect.yMaximum() - ext.yMinimum()) / ext.height() * self.ny) + 1)
+        if i0 >= i1 or j0 >= j1 :
+            return None
+        v = self.values[j0:j1, i0:i1]
+        v = v[~np.isnan(v)]
+        return float(v.min()) if v.size else None
+
+
+class layerSource :
+    # snapshot of a vector layer that can be read from a background thread
+
+    def __init__(self, layer) :
+        self.source = QgsVectorLayerFeatureSource(layer)
+        self.layerFields = layer.fields()
+        self.layerCrs = layer.crs()
+        self.layerExtent = layer.extent()
+        self.count = layer.featureCount()
+        self.transformContext = QgsProject.instance().transformContext()
+
+    def getFeatures(self, request = None) :
+        return self.source.getFeatures(request if request is not None else QgsFeatureRequest())
+
+    def fields(self) :
+        return self.layerFields
+
+    def crs(self) :
+        return self.layerCrs
+
+    def extent(self) :
+        return self.layerExtent
+
+    def featureCount(self) :
+        return self.count
+
+
+class rasterSource :
+    # snapshot of a raster layer that can be read from a background thread
+
+    def __init__(self, layer) :
+        self.provider = layer.dataProvider().clone()
+        self.layerCrs = layer.crs()
+        self.layerExtent = layer.extent()
+        self.size = (layer.width(), layer.height())
+
+    def dataProvider(self) :
+        return self.provider
+
+    def crs(self) :
+        return self.layerCrs
+
+    def extent(self) :
+        return self.layerExtent
+
+    def width(self) :
+        return self.size[0]
+
+    def height(self) :
+        return self.size[1]
+
+
+def wkbParts(wkb, offset = 0, parts = None) :
+    """Return the list of the coordinates arrays (n x 2) of the points,
+    lines and polygon rings of a WKB geometry (without curves), and the
+    offset at the end of the geometry. Points have a single coordinate,
+    lines with less than 2 points are ignored."""
+    if parts is None :
+        parts = []
+    endian = "<" if wkb[offset] == 1 else ">"
+    t = struct.unpack_from(endian + "I", wkb, offset + 1)[0]
+    offset += 5
+    # ISO WKB dimension offsets and EWKB flags
+    zm = (t & 0xffff) // 1000
+    nd = 2 + (zm in (1, 3)) + (zm in (2, 3)) + bool(t & 0x80000000) + bool(t & 0x40000000)
+    base = (t & 0xffff) % 1000
+    def coords(offset) :
+        n = struct.unpack_from(endian + "I", wkb, offset)[0]
+        x = np.frombuffer(wkb, endian + "f8", n * nd, offset + 4).reshape(n, nd)[:, :2]
+        return x, offset + 4 + 8 * n * nd
+    if base == 1 :
+        x = np.frombuffer(wkb, endian + "f8", nd, offset).reshape(1, nd)[:, :2]
+        if not np.isnan(x).any() :
+            parts.append(x)
+        return parts, offset + 8 * nd
+    if base == 2 :
+        x, offset = coords(offset)
+        if x.shape[0] > 1 :
+            parts.append(x)
+        return parts, offset
+    n = struct.unpack_from(endian + "I", wkb, offset)[0]
+    offset += 4
+    for i in range(n) :
+        if base == 3 :
+            x, offset = coords(offset)
+            if x.shape[0] > 1 :
+                parts.append(x)
+        else :
+            _, offset = wkbParts(wkb, offset, parts)
+    return parts, offset
+
+
+# number of features read at once before being handed to the writer
+exportChunkSize = 1000
+
+def exportGeo(geo, filename, layers, insideLayers, sizeLayer, crs, forceAllBnd, task,
+        cellSize = None, aggregation = "min", nodataSize = None, simplify = None, clip = None) :
+    """Export the layers (layerSource) with geo, a geometryWriter, and
+    the mesh size layer (rasterSource). The progress is reported to task, a
+    QgsTask. If simplify is given, the lines and polygons are simplified
+    (Douglas-Peucker) with a tolerance of simplify times their mesh_size
+    attribute, or the minimum of the mesh size layer around them. If clip
+    (a QgsGeometry in the output crs) is given, only the features
+    intersecting it are exported.
+
+    The layers are read, transformed and converted to coordinates arrays
+    concurrently by a pool of threads, the writer is fed one layer after
+    the other from the calling thread."""
+    progress = tools.taskProgress(task, 0, 90 if sizeLayer else 100)
+    progress.setTotal(sum((layer.featureCount() for layer in layers + insideLayers)))
     basename = filename[:-4] if filename[-4:] == ".geo" else filename
 
     if sizeLayer :
         crs = sizeLayer.crs()
-    def addLayer(layer, progress, inside) :
-        name = layer.name()
-        fields = layer.fields()
-        mesh_size_idx = fields.indexFromName("mesh_size")
-        physical_idx = fields.indexFromName("physical")
-        xform = QgsCoordinateTransform(layer.crs(), crs,QgsProject.instance())
-        lc = None
-        physical = None
-        for feature in layer.getFeatures() :
-            progress.setValue(progress.value() + 1)
-            if progress.wasCanceled():
-                return False
-            geom = feature.geometry()
-            if geom is None :
+    sizeGrid = minimumSizeGrid(sizeLayer) if simplify and sizeLayer else None
+    def simplified(geom, lc) :
+        size = lc if lc else (sizeGrid.minimum(geom.boundingBox()) if sizeGrid else None)
+        if not size or size <= 0 :
+            return geom
+        # the first and last points of the lines and rings are kept, so the
+        # pieces still join
+        s = geom.simplify(simplify * size)
+        return geom if s.isEmpty() else s
+    stop = threading.Event()
+    def put(out, item) :
+        # the queues are bounded, give up when the export is stopped
+        while not (stop.is_set() or task.isCanceled()) :
+            try :
+                out.put(item, timeout = 0.1)
+                return True
+            except queue.Full :
+                pass
+        return False
+    def readLayer(layer, out) :
+        # put chunks of (coordinates, lc, physical) in out, then None
+        try :
+            fields = layer.fields()
+            mesh_size_idx = fields.indexFromName("mesh_size")
+            physical_idx = fields.indexFromName("physical")
+            # the features are transformed as a whole, not point by point
+            xform = None
+            if layer.crs() != crs :
+                xform = QgsCoordinateTransform(layer.crs(), crs, layer.transformContext)
+            request = QgsFeatureRequest()
+            request.setSubsetOfAttributes([i for i in (mesh_size_idx, physical_idx) if i >= 0])
+            clipEngine = None
+            if clip is not None :
+                # the rectangle is filtered by the provider, with its spatial
+                # index, the exact test is done on the transformed features
+                toLayer = QgsCoordinateTransform(crs, layer.crs(), layer.transformContext)
+                request.setFilterRect(toLayer.transformBoundingBox(clip.boundingBox()))
+                clipEngine = QgsGeometry.createGeometryEngine(clip.constGet())
+                clipEngine.prepareGeometry()
+            lc = None
+            physical = None
+            chunk = []
+            for feature in layer.getFeatures(request) :
+                if not progress.advance() :
+                    return
+                geom = feature.geometry()
+                if geom.isNull() :
+                    continue
+                if QgsWkbTypes.isCurvedType(geom.wkbType()) :
+                    geom.convertToStraightSegment()
+                if xform :
+                    geom.transform(xform)
+                if clipEngine and not clipEngine.intersects(geom.constGet()) :
+                    continue
+                if mesh_size_idx >= 0 :
+                    lc = feature[mesh_size_idx]
+                if physical_idx >= 0 :
+                    physical = feature[physical_idx]
+                if simplify and geom.type() != QgsWkbTypes.PointGeometry :
+                    geom = simplified(geom, lc)
+                for x in wkbParts(bytes(geom.asWkb()))[0] :
+                    chunk.append((x, lc, physical))
+                if len(chunk) >= exportChunkSize :
+                    if not put(out, chunk) :
+                        return
+                    chunk = []
+            put(out, chunk)
+        finally :
+            put(out, None)
+    def writeLayer(q, future, inside) :
+        while True :
+            try :
+                chunk = q.get(timeout = 0.1)
+            except queue.Empty :
+                if task.isCanceled() :
+                    return False
                 continue
-            if mesh_size_idx >= 0 :
-                lc = feature[mesh_size_idx]
-            if physical_idx >= 0 :
-                physical = feature[physical_idx]
-            if geom.type() == QgsWkbTypes.PolygonGeometry :
-                polys = geom.asMultiPolygon()
-                if not polys :
-                    for loop in geom.asPolygon() :
-                        geo.addLineFromCoords(loop, xform, lc, physical, inside, forceAllBnd)
-                else:
-                    for poly in polys:
-                        for loop in poly :
-                            geo.addLineFromCoords(loop, xform, lc, physical, inside, forceAllBnd)
-            elif geom.type() == QgsWkbTypes.LineGeometry :
-                lines = geom.asMultiPolyline()
-                if not lines :
-                    geo.addLineFromCoords(geom.asPolyline(), xform, lc, physical, inside, forceAllBnd)
+            if chunk is None :
+                break
+            for x, lc, physical in chunk :
+                if x.shape[0] == 1 :
+                    geo.addPointFromCoordInside(x[0].tolist(), lc)
                 else :
-                    for line in lines :
-                        geo.addLineFromCoords(line, xform, lc, physical, inside, forceAllBnd)
-            elif geom.type() == QgsWkbTypes.PointGeometry :
-                point = geom.asPoint()
-                progress.setValue(progress.value() + 1)
-                geo.addPointFromCoordInside(point, xform, lc)
-    for l in layers :
-        addLayer(l, progress, False)
-    for l in insideLayers :
-        addLayer(l, progress, True)
-    del progress
+                    geo.addLineFromCoords(x.tolist(), lc, physical, inside, forceAllBnd)
+        # raise the exceptions of the reading thread
+        future.result()
+        return not task.isCanceled()
+    allLayers = [(l, False) for l in layers] + [(l, True) for l in insideLayers]
+    nthreads = max(1, min(len(allLayers), os.cpu_count() or 1))
+    with concurrent.futures.ThreadPoolExecutor(nthreads) as pool :
+        # the layers are submitted in the order they are consumed, so the
+        # consumed layer is always being read
+        queues = [queue.Queue(16) for l in allLayers]
+        futures = [pool.submit(readLayer, l, q) for (l, _), q in zip(allLayers, queues)]
+        try :
+            status = all(writeLayer(q, future, inside)
+                for (_, inside), q, future in zip(allLayers, queues, futures))
+        finally :
+            # release the reading threads waiting on a full queue
+            stop.set()
+    if not status :
+        return False
+    for x0, x1 in geo.writeLineLoops() :
+        QgsMessageLog.logMessage("Open boundary from (%.16g, %.16g) to (%.16g, %.16g)" %
+            (x0[0], x0[1], x1[0], x1[1]), "Gmsh", Qgis.Warning)
     if sizeLayer :
-        if not writeRasterLayer(sizeLayer, basename + ".dat") :
+        extent = None
+        if cellSize :
+            extent = layersExtent(layers + insideLayers, crs)
+            if clip is not None :
+                extent = extent.intersect(clip.boundingBox())
+            extent.grow(cellSize)
+        if not writeRasterLayer(sizeLayer, basename + ".dat", tools.taskProgress(task, 90, 100),
+                extent, cellSize, aggregation, nodataSize) :
             return False
         geo.setBackgroundField(basename + ".dat")
     return True
 
 
+class ExportGeoTask(QgsTask) :
+    # run exportGeo in a background thread and finalize the writer,
+    # onFinished(task, status) is called from the main thread. newWriter
+    # creates the writer in the background thread, so that nothing is opened
+    # if the task is canceled before it starts.
+
+    def __init__(self, newWriter, args, kwargs, onFinished) :
+        super(ExportGeoTask, self).__init__("Generate a Gmsh geometry file", QgsTask.CanCancel)
+        self.newWriter = newWriter
+        self.geo = None
+        self.args = args
+        self.kwargs = kwargs
+        self.onFinished = onFinished
+        self.exception = None
+
+    def run(self) :
+        try :
+            self.geo = self.newWriter()
+            with self.geo :
+                status = exportGeo(self.geo, *self.args, task = self, **self.kwargs)
+                if not status :
+                    self.geo.abort()
+            return status
+        except Exception as e :
+            self.exception = e
+            return False
+
+    def finished(self, result) :
+        self.onFinished(self, result)
+
+
+def numberValidator(positive) :
+    validator = QDoubleValidator()
+    validator.setNotation(QDoubleValidator.ScientificNotation)
+    # the bottom is inclusive, a strictly positive value needs a tiny one
+    validator.setBottom(sys.float_info.min if positive else 0)
+    return validator
+
+
+def numberValue(widget, default = None) :
+    """Value of a line edit with a numberValidator, in the locale of the
+    validator, default if it is empty or not acceptable."""
+    if not widget.text() or not widget.hasAcceptableInput() :
+        return default
+    value, ok = widget.validator().locale().toDouble(widget.text())
+    return value if ok else default
+
+
 class Dialog(QtWidgets.QDialog) :
 
     def __init__(self, mainWindow, iface, meshDialog) :
@@ -258,11 +867,40 @@ class Dialog(QtWidgets.QDialog) :
         tools.TitleLayout("Mesh Boundaries", self.geometrySelector, layout)
         self.forceAllBndButton = QtWidgets.QCheckBox("Force all boundary points")
         layout.addWidget(self.forceAllBndButton)
+        self.meshDirectlyButton = QtWidgets.QCheckBox("Mesh directly, without writing the geometry file")
+        layout.addWidget(self.meshDirectlyButton)
+        self.simplify = QtWidgets.QLineEdit()
+        self.simplify.setValidator(numberValidator(False))
+        self.simplify.setPlaceholderText("no simplification")
+        tools.TitleLayout("Line simplification tolerance (relative to the mesh size)", self.simplify, layout)
+        self.tolerance = QtWidgets.QLineEdit()
+        self.tolerance.setValidator(numberValidator(True))
+        tools.TitleLayout("Boundary points snapping tolerance", self.tolerance, layout)
         self.insideSelector = QtWidgets.QListWidget()
         tools.TitleLayout("Forced line and points inside the domain", self.insideSelector, layout)
         self.meshSizeSelector = QtWidgets.QComboBox(self)
         self.meshSizeSelector.currentIndexChanged.connect(self.onMeshSizeSelectorActivated)
         tools.TitleLayout("Mesh size layer", self.meshSizeSelector, layout)
+        self.meshSizeOptions = QtWidgets.QWidget()
+        optionsLayout = QtWidgets.QFormLayout(self.meshSizeOptions)
+        optionsLayout.setContentsMargins(0, 0, 0, 0)
+        self.cellSize = QtWidgets.QLineEdit()
+        self.cellSize.setValidator(numberValidator(True))
+        self.cellSize.setPlaceholderText("native resolution")
+        optionsLayout.addRow("Resample to cell size", self.cellSize)
+        self.aggregationSelector = QtWidgets.QComboBox()
+        self.aggregationSelector.addItem("Minimum", "min")
+        self.aggregationSelector.addItem("Maximum", "max")
+        self.aggregationSelector.addItem("Mean", "mean")
+        optionsLayout.addRow("Aggregation", self.aggregationSelector)
+        self.nodataSize = QtWidgets.QLineEdit()
+        self.nodataSize.setValidator(numberValidator(True))
+        self.nodataSize.setPlaceholderText("keep nodata")
+        optionsLayout.addRow("Mesh size on nodata cells", self.nodataSize)
+        layout.addWidget(self.meshSizeOptions)
+        self.meshSizeOptions.hide()
+        self.clipSelector = QtWidgets.QComboBox(self)
+        tools.TitleLayout("Only export the features intersecting", self.clipSelector, layout)
         self.projectionButton = QgsProjectionSelectionWidget()
         tools.TitleLayout("Projection", self.projectionButton, layout).label
         self.projectionLabel = QtWidgets.QLabel()
@@ -270,11 +908,15 @@ class Dialog(QtWidgets.QDialog) :
         self.projectionLabel.hide()
         self.outputFile = tools.FileSelectorLayout("Output file", iface.mainWindow(), "save", "*.geo", layout)
         self.outputFile.fileWidget.textChanged.connect(self.validate)
+        self.numberFields = [self.simplify, self.tolerance, self.cellSize, self.nodataSize]
+        for field in self.numberFields :
+            field.textChanged.connect(self.validate)
         self.geometrySelector.itemChanged.connect(self.validate)
         self.runLayout = tools.CancelRunLayout(self, "Generate geometry file", self.saveGeo, layout)
         self.setLayout(layout)
         self.forceAllBndButton.stateChanged.connect(self.validate)
         self.iface = iface
+        self.tasks = set()
         self.resize(max(450, self.width()), self.height())
 
     def validate(self) :
@@ -292,7 +934,9 @@ class Dialog(QtWidgets.QDialog) :
             else :
                 item.setFlags(item.flags() | Qt.ItemIsEnabled)
 
-        self.runLayout.runButton.setEnabled(bool(outputFile != "" and  activeLayers))
+        # intermediate numbers (e.g. "1e" or "0" for a positive value) are refused
+        numbersValid = all(f.hasAcceptableInput() for f in self.numberFields if f.text())
+        self.runLayout.runButton.setEnabled(bool(outputFile != "" and  activeLayers and numbersValid))
 
     def saveGeo(self) :
         filename = self.outputFile.getFile()
@@ -312,7 +956,20 @@ class Dialog(QtWidgets.QDialog) :
         crs = self.projectionButton.crs()
         if meshSizeLayer :
             crs = meshSizeLayer.crs()
+            # e.g. complex or color rasters can not be read as mesh sizes
+            if meshSizeLayer.dataProvider().dataType(1) not in rasterDataTypes :
+                self.iface.messageBar().pushCritical("Gmsh", "The data type of the mesh size layer is not supported, "
+                    "the first band must contain integer or real numbers.")
+                return
         forceAllBnd = self.forceAllBndButton.isChecked()
+        meshDirectly = self.meshDirectlyButton.isChecked()
+        tolerance = numberValue(self.tolerance, 1e-8)
+        cellSize = numberValue(self.cellSize)
+        aggregation = self.aggregationSelector.itemData(self.aggregationSelector.currentIndex())
+        nodataSize = numberValue(self.nodataSize)
+        simplify = numberValue(self.simplify)
+        clipData = self.clipSelector.itemData(self.clipSelector.currentIndex())
+        clip = self.clipGeometry(clipData, crs)
         proj = QgsProject.instance()
         proj.writeEntry("gmsh", "geo_file", filename)
         proj.writeEntry("gmsh", "ignored_boundary_layers", "%%".join((l.id() for l in ignoredLayers)))
@@ -320,19 +977,66 @@ class Dialog(QtWidgets.QDialog) :
         proj.writeEntry("gmsh", "projection",crs.authid())
         proj.writeEntry("gmsh", "mesh_size_layer", "None" if meshSizeLayer is None else meshSizeLayer.id())
         proj.writeEntry("gmsh", "force_all_boundary_points", "True" if forceAllBnd else "False")
-        status = exportGeo(filename, activeLayers, insideLayers, meshSizeLayer, crs, forceAllBnd)
+        proj.writeEntry("gmsh", "mesh_directly", "True" if meshDirectly else "False")
+        proj.writeEntry("gmsh", "snapping_tolerance", self.tolerance.text())
+        proj.writeEntry("gmsh", "simplify", self.simplify.text())
+        proj.writeEntry("gmsh", "clip", clipData if isinstance(clipData, str) else clipData.id())
+        proj.writeEntry("gmsh", "mesh_size_cell_size", self.cellSize.text())
+        proj.writeEntry("gmsh", "mesh_size_aggregation", aggregation)
+        proj.writeEntry("gmsh", "mesh_size_nodata", self.nodataSize.text())
+        if meshDirectly :
+            newWriter = lambda : modelWriter(tolerance)
+        else :
+            newWriter = lambda : geoWriter(filename, tolerance)
+        args = (filename, [layerSource(l) for l in activeLayers], [layerSource(l) for l in insideLayers],
+            rasterSource(meshSizeLayer) if meshSizeLayer else None, crs, forceAllBnd)
+        kwargs = {"cellSize" : cellSize, "aggregation" : aggregation, "nodataSize" : nodataSize, "simplify" : simplify,
+            "clip" : clip}
         self.close()
-        if status :
+        # keep a reference, the task is deleted with its python object
+        task = ExportGeoTask(newWriter, args, kwargs, self.onExportFinished)
+        self.tasks.add(task)
+        QgsApplication.taskManager().addTask(task)
+
+    def clipGeometry(self, clipData, crs) :
+        if clipData == "None" :
+            return None
+        if clipData == "canvas" :
+            canvas = self.iface.mapCanvas()
+            geom = QgsGeometry.fromRect(canvas.extent())
+            srcCrs = canvas.mapSettings().destinationCrs()
+        else :
+            geom = QgsGeometry.unaryUnion([f.geometry() for f in clipData.getFeatures()])
+            srcCrs = clipData.crs()
+        geom.transform(QgsCoordinateTransform(srcCrs, crs, QgsProject.instance()))
+        return geom
+
+    def onExportFinished(self, task, status) :
+        self.tasks.discard(task)
+        bar = self.iface.messageBar()
+        if task.exception is not None :
+            bar.pushCritical("Gmsh", "Geometry export failed : %s" % task.exception)
+            return
+        if not status :
+            return
+        if task.geo.dangling :
+            bar.pushWarning("Gmsh", "%d boundary lines are not part of a closed loop, see the Gmsh log messages."
+                % len(task.geo.dangling))
+        if isinstance(task.geo, modelWriter) :
+            self.meshDialog.execModel(task.geo.model)
+        else :
             self.meshDialog.exec_()
 
     def onMeshSizeSelectorActivated(self, idx) :
         layer = self.meshSizeSelector.itemData(idx)
         if layer is None :
             self.projectionLabel.hide()
+            self.meshSizeOptions.hide()
             self.projectionButton.show()
         else :
             self.projectionButton.hide()
             self.projectionLabel.show()
+            self.meshSizeOptions.show()
             self.projectionLabel.setText("%s" % (layer.crs().description()))
 
     def exec_(self) :
@@ -344,6 +1048,14 @@ class Dialog(QtWidgets.QDialog) :
         projid = proj.readEntry("gmsh", "projection", "")[0]
         forceAllBnd = proj.readEntry("gmsh","force_all_boundary_points", "False")[0] == "True"
         self.forceAllBndButton.setCheckState(Qt.Checked if forceAllBnd else Qt.Unchecked)
+        meshDirectly = proj.readEntry("gmsh","mesh_directly", "False")[0] == "True"
+        self.meshDirectlyButton.setCheckState(Qt.Checked if meshDirectly else Qt.Unchecked)
+        self.tolerance.setText(proj.readEntry("gmsh", "snapping_tolerance", "1e-8")[0])
+        self.simplify.setText(proj.readEntry("gmsh", "simplify", "")[0])
+        self.cellSize.setText(proj.readEntry("gmsh", "mesh_size_cell_size", "")[0])
+        idx = self.aggregationSelector.findData(proj.readEntry("gmsh", "mesh_size_aggregation", "min")[0])
+        self.aggregationSelector.setCurrentIndex(max(idx, 0))
+        self.nodataSize.setText(proj.readEntry("gmsh", "mesh_size_nodata", "")[0])
         crs = None
         if projid :
             crs = QgsCoordinateReferenceSystem(projid)
@@ -355,6 +1067,12 @@ class Dialog(QtWidgets.QDialog) :
         self.insideSelector.clear()
         self.meshSizeSelector.clear()
         self.meshSizeSelector.addItem("None", None)
+        clipId = proj.readEntry("gmsh", "clip", "None")[0]
+        self.clipSelector.clear()
+        self.clipSelector.addItem("All features", "None")
+        self.clipSelector.addItem("Map canvas extent", "canvas")
+        if clipId == "canvas" :
+            self.clipSelector.setCurrentIndex(1)
         for layer in layers :
             if layer.type() == QgsMapLayer.VectorLayer :
                 item = QtWidgets.QListWidgetItem(layer.name(), self.geometrySelector)
@@ -365,6 +1083,10 @@ class Dialog(QtWidgets.QDialog) :
                 item.setData(Qt.UserRole, layer)
                 item.setFlags(item.flags() & ~ Qt.ItemIsSelectable)
                 item.setCheckState(Qt.Checked if layer.id() in insideLayers else Qt.Unchecked)
+                if layer.geometryType() == QgsWkbTypes.PolygonGeometry :
+                    self.clipSelector.addItem(layer.name(), layer)
+                    if layer.id() == clipId :
+                        self.clipSelector.setCurrentIndex(self.clipSelector.count() - 1)
             if layer.type() == QgsMapLayer.RasterLayer :
                 self.meshSizeSelector.addItem(layer.name(), layer)
                 if layer.id() == meshSizeLayerId :
@@ -1,115 +1,442 @@
 # author  : Jonathan Lambrechts jonathan.lambrechts@uclouvain.be
 # licence : GPLv2 (see LICENSE.md)
 
-from PyQt5.QtCore import Qt,QDir,QThread,QFileInfo,QFile
+from PyQt5.QtCore import Qt,QDir,QThread,QFileInfo,QFile,QVariant
 from PyQt5 import QtWidgets
-from qgis.core import QgsProject,QgsFeature,QgsGeometry,QgsCoordinateReferenceSystem,QgsVectorLayer
-from qgis import processing
+from qgis.core import QgsProject,QgsFeature,QgsGeometry,QgsCoordinateReferenceSystem,QgsVectorLayer,QgsField,QgsFeatureRequest,QgsApplication,QgsMeshLayer,QgsTask
+from PyQt5.QtGui import QIntValidator
 import os
+import shutil
+import threading
 from . import tools
 from qgis.gui import QgsProjectionSelectionWidget
 import numpy as np
 
-def loadMsh(filename, crs):
+# gmsh element type -> dimension of the elements loaded
+elementDims = {15 : 0, 1 : 1, 2 : 2, 3 : 2}
+
+def nodeIndex(tags) :
+    """Return a function mapping node tags to their position in tags.
+    A dense index array is used unless the numbering is very sparse."""
+    if tags.size == 0 or tags.max() > 4 * tags.size + 1024 :
+        order = tags.argsort()
+        return lambda t : order[np.searchsorted(tags, t, sorter=order)]
+    index = np.zeros(tags.max() + 1, np.int64)
+    index[tags] = np.arange(tags.size)
+    return lambda t : index[t]
+
+
+class meshData :
+    """All the nodes and elements (of dimension 0 to 2) of the current gmsh
+    model, stored in a few flat arrays.
+    xyz : (n, 3) node coordinates
+    entities : list of the (dim, tag) of the model entities
+    elements : element type -> (element tags, entity index, node index) where
+    node index is a (m, nodes per element) array of positions in xyz
+    groups : list of (name, dim, entity indices), one for each physical group
+    followed by one for each entity of dimension 1 or 2 which is not in a
+    physical group"""
+
+    def __init__(self) :
+        import gmsh
+        nodes_tag, nodes_xyz, _ = gmsh.model.mesh.get_nodes()
+        self.nodeTags = nodes_tag
+        self.xyz = nodes_xyz.reshape(-1, 3)
+        index = nodeIndex(nodes_tag)
+        self.entities = [(d, t) for d, t in gmsh.model.get_entities() if d <= 2]
+        entityId = dict((e, i) for i, e in enumerate(self.entities))
+        # the gmsh API has no bulk element -> entity query : fetch each
+        # entity once (all element types together) and concatenate by type
+        chunks = {}
+        for i, (edim, etag) in enumerate(self.entities) :
+            for t, tags, nodes in zip(*gmsh.model.mesh.get_elements(edim, etag)) :
+                if t in elementDims and tags.size :
+                    chunks.setdefault(t, []).append((i, tags, nodes))
+        self.elements = {}
+        for t, c in chunks.items() :
+            tags = np.concatenate([tags for _, tags, _ in c])
+            entity = np.repeat([i for i, _, _ in c], [tags.size for _, tags, _ in c])
+            nodes = np.concatenate([nodes for _, _, nodes in c])
+            self.elements[t] = (tags, entity, index(nodes).reshape(tags.size, -1))
+        self.groups = []
+        assigned = set()
+        for pdim, ptag in gmsh.model.get_physical_groups() :
+            if pdim > 2 : continue
+            name = gmsh.model.get_physical_name(pdim, ptag)
+            if not name :
+                name = "physical_"+str(pdim)+"_"+str(ptag)
+            ids = [entityId[(pdim, etag)] for etag in gmsh.model.get_entities_for_physical_group(pdim, ptag)]
+            assigned.update(ids)
+            self.groups.append((name, pdim, np.array(ids, np.int64)))
+        for i, (edim, etag) in enumerate(self.entities) :
+            # the geometry points are in the nodes layer, if needed
+            if i not in assigned and edim > 0 :
+                self.groups.append(("entity_"+str(edim)+"_"+str(etag), edim, np.array([i])))
+
+    def groupElements(self, dim, ids) :
+        """Yield (element type, selection mask) for the elements of dimension
+        dim which belong to the entities ids."""
+        inGroup = np.zeros(len(self.entities), bool)
+        inGroup[ids] = True
+        for t, (tags, entity, nodes) in self.elements.items() :
+            if elementDims[t] == dim :
+                yield t, inGroup[entity]
+
+    def edges(self) :
+        """Return the unique edges of the 2d elements as an (n, 2) array of
+        node indices."""
+        edges = [np.stack([nodes, np.roll(nodes, -1, 1)], 2).reshape(-1, 2)
+            for t, (tags, entity, nodes) in self.elements.items() if elementDims[t] == 2]
+        if not edges :
+            return np.empty((0, 2), np.int64)
+        edges = np.sort(np.concatenate(edges), 1)
+        n = self.xyz.shape[0]
+        keys = np.unique(edges[:,0] * n + edges[:,1])
+        return np.stack([keys // n, keys % n], 1)
+
+    def attributes(self, t, sel) :
+        """Return the attribute columns (in the order of attributeFields) of
+        the elements of type t selected by sel."""
+        import gmsh
+        tags, entity, nodes = self.elements[t]
+        tags = tags[sel]
+        entityTags = np.array([etag for _, etag in self.entities], np.int64)
+        columns = [tags, entityTags[entity[sel]]]
+        xy = self.xyz[nodes[sel]][:,:,:2]
+        if elementDims[t] == 1 :
+            length = np.hypot(*(xy[:,1,:] - xy[:,0,:]).T)
+            columns += [length, length]
+        elif elementDims[t] == 2 :
+            x, y = xy[:,:,0], xy[:,:,1]
+            area = 0.5 * np.abs(np.sum(x * np.roll(y, -1, 1) - np.roll(x, -1, 1) * y, 1))
+            # edge length of the equilateral triangle or square of same area
+            size = np.sqrt(area * 4 / 3**0.5) if t == 2 else np.sqrt(area)
+            columns += [area, size]
+            for quality in ("gamma", "minSICN") :
+                columns.append(gmsh.model.mesh.get_element_qualities(tags, quality))
+        return columns
+
+
+# attributes of the elements of each dimension, as computed by meshData.attributes
+attributeFields = {
+    0 : [("element", QVariant.LongLong), ("entity", QVariant.Int)],
+    1 : [("element", QVariant.LongLong), ("entity", QVariant.Int),
+        ("length", QVariant.Double), ("size", QVariant.Double)],
+    2 : [("element", QVariant.LongLong), ("entity", QVariant.Int),
+        ("area", QVariant.Double), ("size", QVariant.Double),
+        ("gamma", QVariant.Double), ("sicn", QVariant.Double)]
+}
+
+
+def elementsWkb(dim, xy) :
+    """Return the single part WKB geometries of the elements xy (an (n, nodes
+    per element, 2) array) as the rows of an (n, bytes per element) array."""
+    n, nv = xy.shape[:2]
+    if dim == 0 :
+        dtype = np.dtype([("o",np.byte), ("t",np.uint32), ("x",np.float64,2)])
+    elif dim == 1 :
+        dtype = np.dtype([("o",np.byte), ("t",np.uint32), ("n",np.uint32), ("x",np.float64,(nv,2))])
+    else :
+        dtype = np.dtype([("o",np.byte), ("t",np.uint32), ("n",np.uint32), ("m",np.uint32), ("x",np.float64,(nv+1,2))])
+    wkbn = np.empty(n, dtype=dtype)
+    wkbn["o"] = 1
+    wkbn["t"] = dim+1
+    if dim == 2:
+        wkbn["n"] = 1
+        wkbn["m"] = nv+1
+        wkbn["x"][:,:nv,:] = xy
+        wkbn["x"][:,nv,:] = xy[:,0,:]
+    elif dim == 1:
+        wkbn["n"] = nv
+        wkbn["x"] = xy
+    else:
+        wkbn["x"] = xy[:,0,:]
+    return wkbn.view(np.uint8).reshape(n, dtype.itemsize)
+
+
+def groupFeatures(mesh, dim, ids, attributes) :
+    """Yield the (wkb, attribute row or None) of the elements of a group."""
+    for t, sel in mesh.groupElements(dim, ids) :
+        xy = mesh.xyz[mesh.elements[t][2][sel]][:,:,:2]
+        wkbs = elementsWkb(dim, xy)
+        if attributes :
+            yield from zip(wkbs, zip(*(c.tolist() for c in mesh.attributes(t, sel))))
+        else :
+            for wkb in wkbs :
+                yield wkb, None
+
+
+def meshLayers(mesh, attributes, edges=False, nodes=False) :
+    """Return the list of the (name, dim, fields, number of features,
+    features) of the layers to create : one per group, then optionally the
+    unique edges and the nodes. The features are generated lazily."""
+    layers = []
+    for name, pdim, ids in mesh.groups :
+        fields = attributeFields[pdim] if attributes else []
+        count = sum(int(sel.sum()) for _, sel in mesh.groupElements(pdim, ids))
+        layers.append((name, pdim, fields, count, groupFeatures(mesh, pdim, ids, attributes)))
+    if edges :
+        xy = mesh.xyz[mesh.edges()][:,:,:2]
+        layers.append(("edges", 1, [], xy.shape[0], ((wkb, None) for wkb in elementsWkb(1, xy))))
+    if nodes :
+        wkbs = elementsWkb(0, mesh.xyz[:,None,:2])
+        layers.append(("nodes", 0, [("node", QVariant.LongLong)], wkbs.shape[0], zip(wkbs, zip(mesh.nodeTags.tolist()))))
+    return layers
+
+
+def countedFeatures(features, progress, chunk=10000) :
+    """Yield features and advance progress by their number, stop early if the
+    task is canceled."""
+    n = 0
+    for feature in features :
+        yield feature
+        n += 1
+        if n == chunk :
+            if not progress.advance(n) :
+                return
+            n = 0
+    progress.advance(n)
+
+
+def memoryLayer(name, dim, crs, fields, features) :
+    layer = QgsVectorLayer(["Point","LineString","Polygon"][dim],name,"memory")
+    layer.setCrs(crs)
+    if fields:
+        layer.dataProvider().addAttributes([QgsField(n, t) for n, t in fields])
+        layer.updateFields()
+    qfeatures = []
+    for wkb, row in features:
+        geom = QgsGeometry()
+        geom.fromWkb(wkb.tobytes())
+        feature = QgsFeature()
+        feature.setGeometry(geom)
+        if row is not None:
+            feature.setAttributes(list(row))
+        qfeatures.append(feature)
+    layer.dataProvider().addFeatures(qfeatures)
+    layer.updateExtents()
+    return layer
+
+
+def gpkgTable(ds, srs, name, dim, fields, features) :
+    """Write features in a new table of the GeoPackage ds, in a single
+    transaction."""
+    from osgeo import ogr
+    ogrTypes = {QVariant.LongLong : ogr.OFTInteger64, QVariant.Int : ogr.OFTInteger, QVariant.Double : ogr.OFTReal}
+    table = ds.CreateLayer(name, srs, [ogr.wkbPoint, ogr.wkbLineString, ogr.wkbPolygon][dim], ["SPATIAL_INDEX=YES"])
+    for n, t in fields :
+        table.CreateField(ogr.FieldDefn(n, ogrTypes[t]))
+    defn = table.GetLayerDefn()
+    ds.StartTransaction()
+    for wkb, row in features :
+        feature = ogr.Feature(defn)
+        feature.SetGeometryDirectly(ogr.CreateGeometryFromWkb(wkb.tobytes()))
+        if row is not None :
+            for i, v in enumerate(row) :
+                feature.SetField(i, v)
+        table.CreateFeature(feature)
+    ds.CommitTransaction()
+
+
+def writeGpkg(layers, gpkg, crs) :
+    """Write the (name, dim, fields, features) layers in the GeoPackage file
+    gpkg, one table per layer, and return the table names."""
+    from osgeo import ogr, osr
+    driver = ogr.GetDriverByName("GPKG")
+    if os.path.exists(gpkg):
+        driver.DeleteDataSource(gpkg)
+    ds = driver.CreateDataSource(gpkg)
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(crs.toWkt())
+    names = []
+    for name, dim, fields, features in layers:
+        gpkgTable(ds, srs, name, dim, fields, features)
+        names.append(name)
+    return names
+
+
+def gpkgTableNames(gpkg) :
+    from osgeo import ogr
+    ds = ogr.Open(gpkg)
+    return [ds.GetLayer(i).GetName() for i in range(ds.GetLayerCount())]
+
+
+def write2dm(mesh, filename) :
+    """Write the nodes and the 2d elements of mesh in the 2DM format, the
+    material id of an element being its entity tag."""
+    entityTags = np.array([etag for _, etag in mesh.entities], np.int64)
+    tmp = filename + ".tmp"
+    with open(tmp, "w") as f :
+        f.write("MESH2D\n")
+        ids = np.arange(1, mesh.xyz.shape[0] + 1)
+        np.savetxt(f, np.column_stack([ids, mesh.xyz]), "ND %d %.17g %.17g %.17g")
+        first = 1
+        for t, (tags, entity, nodes) in mesh.elements.items() :
+            if elementDims[t] != 2 : continue
+            n = tags.size
+            rows = np.column_stack([np.arange(first, first + n), nodes + 1, entityTags[entity]])
+            fmt = ("E3T" if nodes.shape[1] == 3 else "E4Q") + " %d" * (nodes.shape[1] + 2)
+            np.savetxt(f, rows, fmt)
+            first += n
+    os.replace(tmp, filename)
+
+
+# gmsh has a single global state
+gmshLock = threading.Lock()
+
+def gmshInitialize() :
     import gmsh
-    progress = QtWidgets.QProgressDialog("Reading mesh...", "Abort", 0, 30)
-    progress.setMinimumDuration(1000)
-    progress.setWindowModality(Qt.WindowModal)
-    gmsh.initialize()
-    progress.setValue(1)
-    QtWidgets.QApplication.processEvents()
-    if progress.wasCanceled(): return
-    gmsh.open(filename)
-    progress.setValue(10)
-    QtWidgets.QApplication.processEvents()
-    nodes_tag, nodes_xyz, _ = gmsh.model.mesh.get_nodes()
-    nodes_xyz = nodes_xyz.reshape(-1, 3)
-    nodes_order = nodes_tag.argsort()
-    paths = []
-    elements = {}
-    written = []
-    def get_xyz(e):
-        return nodes_xyz[nodes_order[np.searchsorted(nodes_tag, e, sorter=nodes_order)]]
-    def get_entity(edim, etag, els):
-        QtWidgets.QApplication.processEvents()
-        if progress.wasCanceled(): return
-        if edim == 0:
-            els.append(get_xyz(gmsh.model.mesh.get_elements_by_type(15, etag)[1]))
-        if edim == 1:
-            els.append(get_xyz(gmsh.model.mesh.get_elements_by_type(1, etag)[1].reshape(-1,2)))
-        if edim == 2:
-            els.append(get_xyz(gmsh.model.mesh.get_elements_by_type(2, etag)[1].reshape(-1,3)))
-            els.append(get_xyz(gmsh.model.mesh.get_elements_by_type(3, etag)[1].reshape(-1,4)))
-    loaded_entities = []
-    for pdim, ptag in gmsh.model.get_physical_groups():
-        if pdim > 2: continue
-        name = gmsh.model.get_physical_name(pdim, ptag)
-        if name is None:
-            name = "physical_"+str(pdim)+"_"+str(ptag)
-        els = []
-        for etag in gmsh.model.get_entities_for_physical_group(pdim, ptag):
-            get_entity(pdim, etag, els)
-            loaded_entities.append((pdim,etag))
-            elements[name] = (pdim, els)
-    for edim, etag in gmsh.model.get_entities():
-        if edim > 2: continue
-        if (edim,etag) in loaded_entities: continue
-        name = "entity_"+str(edim)+"_"+str(etag)
-        els = []
-        get_entity(edim, etag, els)
-        elements[name] = (edim, els)
-    progress.setValue(20)
-    progress.setLabelText("Writing elements...")
-
-    group = QgsProject.instance().layerTreeRoot().addGroup(QFileInfo(filename).baseName())
-    dtypes = [np.dtype([("o",np.byte), ("t",np.uint32),("x",np.float64,2)], align=False),
-              np.dtype([("o",np.byte), ("t",np.uint32), ("n",np.uint32),("x",np.float64,(2,2))], align=False),
-              np.dtype([("o",np.byte), ("t",np.uint32), ("n",np.uint32), ("m",np.uint32),("x",np.float64,(4,2))], align=False)]
-    for name, (pdim, elements) in elements.items():
-        QtWidgets.QApplication.processEvents()
-        if progress.wasCanceled(): return
-        if pdim != 2 and pdim != 1: continue
-        layer = QgsVectorLayer(["MultiPoint","MultiLineString","MultiPolygon"][pdim],name,"memory")
-        layer.setCrs(crs)
-        prov = layer.dataProvider()
-
-        for els in elements:
-            if els.shape[0] == 0: continue
-            wkbn = np.empty(els.shape[0], dtype=dtypes[pdim])
-            wkbn["o"][:] = 1
-            wkbn["t"][:] = pdim+1
-            if pdim == 2:
-                wkbn["n"][:] = 1
-                wkbn["m"][:] = 4
-                wkbn["x"][:,:3,:] = els[:,:,:2]
-                wkbn["x"][:,3,:] = els[:,0,:2]
-            elif pdim == 1:
-                wkbn["n"][:] = 2
-                wkbn["x"][:,:,:] = els[:,:,:2]
-            else:
-                wkbn["x"][:,:] = els[:,0,:2]
-            wkb = b'\x01'+np.array((pdim+4,els.shape[0]),np.uint32).tobytes()+wkbn.tobytes()
-            geom = QgsGeometry()
-            geom.fromWkb(wkb)
-            feature = QgsFeature()
-            feature.setGeometry(geom)
-            prov.addFeature(feature)
-        QtWidgets.QApplication.processEvents()
-        if progress.wasCanceled(): return
-        layer.updateExtents()
-        alg = processing.run("qgis:multiparttosingleparts",{'INPUT': layer, 'OUTPUT': 'TEMPORARY_OUTPUT'})
-        layer = alg['OUTPUT']
-        layer.setName(name)
-        layer = QgsProject.instance().addMapLayer(layer, False)
-        group.addLayer(layer) 
-    progress.setValue(30)
-    return
+    # the SIGINT handler can only be installed from the main thread
+    try :
+        gmsh.initialize(interruptible=False)
+    except TypeError :
+        gmsh.initialize()
+
+
+class LoadMshTask(QgsTask) :
+    # read a mesh file and build its layers in a background thread,
+    # onFinished(task, status) is called from the main thread to add
+    # task.layers to the project
+    # The layers are the physical groups (and the entities which are not in a
+    # physical group), optionally with the unique edges and the nodes. If
+    # gpkg is given, they are written in this GeoPackage file (one table per
+    # layer) and read from it, otherwise memory layers are created. With a
+    # tools.FileCache, the converted layers are also stored in the cache as a
+    # GeoPackage, reused when the same file is imported again. With meshLayer, a 2DM file
+    # is written next to the mesh file and loaded as a native mesh layer.
+
+    def __init__(self, filename, crs, onFinished, attributes=False, gpkg=None, cache=None,
+            edges=False, nodes=False, meshLayer=False) :
+        super(LoadMshTask, self).__init__("Import a Gmsh mesh file", QgsTask.CanCancel)
+        self.filename = filename
+        self.crs = crs
+        self.onFinished = onFinished
+        self.attributes = attributes
+        self.gpkg = gpkg
+        self.cache = cache
+        self.edges = edges
+        self.nodes = nodes
+        self.meshLayer = meshLayer
+        self.names = []
+        self.cached = None
+        self.layers = []
+        self.exception = None
+
+    def run(self) :
+        try :
+            if not self.load() :
+                return False
+            # the layers are created in this thread but used in the main one
+            for layer in self.layers :
+                layer.moveToThread(QgsApplication.instance().thread())
+            return True
+        except Exception as e :
+            self.exception = e
+            return False
+
+    def load(self) :
+        import gmsh
+        upToDate = False
+        if self.meshLayer :
+            self.path2dm = os.path.splitext(self.filename)[0] + ".2dm"
+            upToDate = os.path.isfile(self.path2dm) and os.path.getmtime(self.path2dm) >= os.path.getmtime(self.filename)
+        elif self.cache is not None :
+            st = os.stat(self.filename)
+            self.key = self.cache.key("msh", tools.fileDigest(self.filename), st.st_size, st.st_mtime_ns,
+                self.crs.toWkt(), self.attributes, self.edges, self.nodes)
+            self.cached = self.cache.get(self.key, ".gpkg")
+            if self.cached :
+                self.names = gpkgTableNames(self.cached)
+                upToDate = True
+        if not upToDate :
+            with gmshLock :
+                gmshInitialize()
+                try :
+                    if not self.convert() :
+                        return False
+                finally :
+                    gmsh.finalize()
+        if self.meshLayer :
+            # created by finished, in the main thread
+            return True
+        if self.layers :
+            # memory layers created by convert
+            return not self.isCanceled()
+        if self.gpkg and self.cached :
+            shutil.copyfile(self.cached, self.gpkg)
+        if self.gpkg or self.cached :
+            source = self.gpkg or self.cached
+            for name in self.names :
+                layer = QgsVectorLayer(source + "|layername=" + name, name, "ogr")
+                if not self.gpkg :
+                    # the cache may be evicted, keep a copy in memory
+                    layer = layer.materialize(QgsFeatureRequest())
+                    layer.setName(name)
+                self.layers.append(layer)
+        return not self.isCanceled()
+
+    def convert(self) :
+        """Read the mesh with gmsh (initialized) and create the memory layers
+        or write the GeoPackage or 2DM file. Return False if canceled."""
+        import gmsh
+        gmsh.open(self.filename)
+        self.setProgress(10)
+        if self.isCanceled() :
+            return False
+        mesh = meshData()
+        self.setProgress(20)
+        if self.meshLayer :
+            write2dm(mesh, self.path2dm)
+            return not self.isCanceled()
+        layers = meshLayers(mesh, self.attributes, self.edges, self.nodes)
+        progress = tools.taskProgress(self, 20, 100)
+        progress.setTotal(sum(count for _, _, _, count, _ in layers))
+        layers = [(name, dim, fields, countedFeatures(features, progress))
+            for name, dim, fields, count, features in layers]
+        if not self.gpkg :
+            for name, dim, fields, features in layers :
+                if self.isCanceled() :
+                    return False
+                self.layers.append(memoryLayer(name, dim, self.crs, fields, features))
+            if self.cache is None or self.isCanceled() :
+                return not self.isCanceled()
+            # the features are generated again from the mesh rather than kept
+            layers = [(name, dim, fields, features)
+                for name, dim, fields, count, features in meshLayers(mesh, self.attributes, self.edges, self.nodes)]
+            return self.fillCache(layers)
+        if self.cache is None :
+            self.names = writeGpkg(layers, self.gpkg, self.crs)
+            return not self.isCanceled()
+        return self.fillCache(layers)
+
+    def fillCache(self, layers) :
+        """Write the (name, dim, fields, features) layers in the cache, return
+        False if canceled."""
+        output = self.cache.tmpFile(".gpkg")
+        try :
+            self.names = writeGpkg(layers, output, self.crs)
+            if self.isCanceled() :
+                return False
+            self.cached = self.cache.put(self.key, ".gpkg", output)
+        finally :
+            if os.path.exists(output) :
+                os.remove(output)
+        return True
+
+    def finished(self, result) :
+        if result and self.meshLayer :
+            layer = QgsMeshLayer(self.path2dm, QFileInfo(self.filename).baseName(), "mdal")
+            layer.setCrs(self.crs)
+            self.layers = [layer]
+        self.onFinished(self, result)
 
 
 class Dialog(QtWidgets.QDialog) :
 
     def __init__(self, mainWindow, iface) :
         self.mainWindow = mainWindow
+        self.iface = iface
+        self.tasks = set()
         super(Dialog, self).__init__(mainWindow)
         self.setWindowTitle("Convert a Gmsh mesh file into shapefiles")
         self.setMinimumWidth(800)
@@ -118,6 +445,22 @@ class Dialog(QtWidgets.QDialog) :
             mainWindow, "open", "*.msh", layout)
         self.projectionButton = QgsProjectionSelectionWidget()
         tools.TitleLayout("Projection", self.projectionButton, layout).label
+        self.attributesButton = QtWidgets.QCheckBox("Element attributes (tag, entity, size and quality)")
+        layout.addWidget(self.attributesButton)
+        self.meshLayerButton = QtWidgets.QCheckBox("Native mesh layer (2DM file next to the mesh file) instead of vector layers")
+        layout.addWidget(self.meshLayerButton)
+        self.outputGpkg = tools.FileSelectorLayout("GeoPackage file",
+            mainWindow, "save", "*.gpkg", layout)
+        self.outputGpkg.fileWidget.setPlaceholderText("none (temporary memory layers)")
+        self.cacheSize = QtWidgets.QLineEdit()
+        validator = QIntValidator()
+        validator.setBottom(0)
+        self.cacheSize.setValidator(validator)
+        self.edgesButton = QtWidgets.QCheckBox("Layer of the unique edges of the 2D elements")
+        layout.addWidget(self.edgesButton)
+        self.nodesButton = QtWidgets.QCheckBox("Layer of the nodes")
+        layout.addWidget(self.nodesButton)
+        tools.TitleLayout("Import cache size in MB (0 to disable)", self.cacheSize, layout)
         self.inputMsh.fileWidget.textChanged.connect(self.validate)
         self.runLayout = tools.CancelRunLayout(self, "Convert", self.loadMsh, layout)
         self.runLayout.runButton.setEnabled(False)
@@ -140,9 +483,37 @@ class Dialog(QtWidgets.QDialog) :
         proj = QgsProject.instance()
         proj.writeEntry("gmsh", "msh_file", inputFile)
         proj.writeEntry("gmsh", "projection", crs.authid())
+        attributes = self.attributesButton.isChecked()
+        proj.writeEntry("gmsh", "msh_attributes", "True" if attributes else "False")
+        edges = self.edgesButton.isChecked()
+        proj.writeEntry("gmsh", "msh_edges", "True" if edges else "False")
+        nodes = self.nodesButton.isChecked()
+        proj.writeEntry("gmsh", "msh_nodes", "True" if nodes else "False")
+        meshLayer = self.meshLayerButton.isChecked()
+        proj.writeEntry("gmsh", "msh_mesh_layer", "True" if meshLayer else "False")
+        gpkg = self.outputGpkg.getFile()
+        proj.writeEntry("gmsh", "msh_gpkg", gpkg)
+        proj.writeEntry("gmsh", "msh_cache_size", self.cacheSize.text() or "0")
         if not tools.install_gmsh_if_needed(self.mainWindow):
             return
-        loadMsh(self.inputMsh.getFile(), crs)
+        # keep a reference, the task is deleted with its python object
+        task = LoadMshTask(inputFile, crs, self.onLoadFinished, attributes, gpkg or None,
+            tools.projectCache("msh_cache_size"), edges, nodes, meshLayer)
+        self.tasks.add(task)
+        QgsApplication.taskManager().addTask(task)
+
+    def onLoadFinished(self, task, status) :
+        self.tasks.discard(task)
+        if task.exception is not None :
+            self.iface.messageBar().pushCritical("Gmsh", "Mesh import failed : %s" % task.exception)
+            return
+        if not status :
+            return
+        proj = QgsProject.instance()
+        group = proj.layerTreeRoot().addGroup(QFileInfo(task.filename).baseName())
+        for layer in task.layers :
+            layer = proj.addMapLayer(layer, False)
+            group.addLayer(layer)
 
     def exec_(self) :
         proj = QgsProject.instance()
@@ -155,6 +526,16 @@ class Dialog(QtWidgets.QDialog) :
         if crs is None or not crs.isValid():
             crs = QgsCoordinateReferenceSystem("EPSG:4326")
         self.projectionButton.setCrs(crs)
+        attributes = proj.readEntry("gmsh", "msh_attributes", "False")[0] == "True"
+        self.attributesButton.setCheckState(Qt.Checked if attributes else Qt.Unchecked)
+        edges = proj.readEntry("gmsh", "msh_edges", "False")[0] == "True"
+        self.edgesButton.setCheckState(Qt.Checked if edges else Qt.Unchecked)
+        nodes = proj.readEntry("gmsh", "msh_nodes", "False")[0] == "True"
+        self.nodesButton.setCheckState(Qt.Checked if nodes else Qt.Unchecked)
+        meshLayer = proj.readEntry("gmsh", "msh_mesh_layer", "False")[0] == "True"
+        self.meshLayerButton.setCheckState(Qt.Checked if meshLayer else Qt.Unchecked)
+        self.outputGpkg.setFile(proj.readEntry("gmsh", "msh_gpkg", "")[0])
+        self.cacheSize.setText(proj.readEntry("gmsh", "msh_cache_size", "1024")[0])
         super(Dialog, self).exec_()
 
 
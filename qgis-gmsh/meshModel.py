@@ -0,0 +1,66 @@
+# author  : Jonathan Lambrechts jonathan.lambrechts@uclouvain.be
+# licence : GPLv2 (see LICENSE.md)
+
+# Mesh a geometry exported in memory by exportGeometry.modelWriter, without
+# going through a .geo file. This script is run in a separate python process
+# by runGmsh.MeshDialog : the pickled model is read on the standard input and
+# the command line arguments are the gmsh ones (-o gives the mesh file).
+
+import sys
+import os
+import pickle
+
+# extension of the mesh file of the -format values of runGmsh.MeshDialog
+formatExtensions = {"msh2" : ".msh", "msh4" : ".msh", "stl" : ".stl", "cgns" : ".cgns"}
+
+def buildModel(model) :
+    import gmsh
+    geo = gmsh.model.geo
+    for i, (x, y, lc) in enumerate(model["points"].tolist()) :
+        geo.addPoint(x, y, 0, lc, i + 1)
+    for i, pts in enumerate(model["splines"]) :
+        geo.addSpline(pts, i + 1)
+    for i, lines in enumerate(model["loops"]) :
+        geo.addCurveLoop(lines, i + 1)
+    for i, loops in enumerate(model["surfaces"]) :
+        geo.addPlaneSurface(loops, i + 1)
+    geo.synchronize()
+    points, lines, surfaces = model["embedded"]
+    for surface in surfaces :
+        if lines :
+            gmsh.model.mesh.embed(1, lines, 2, surface)
+        if points :
+            gmsh.model.mesh.embed(0, points, 2, surface)
+    for dim, name, tags in model["physicals"] :
+        tag = gmsh.model.addPhysicalGroup(dim, tags)
+        gmsh.model.setPhysicalName(dim, tag, name)
+    if model["field"] :
+        field = gmsh.model.mesh.field.add("Structured")
+        gmsh.model.mesh.field.setNumber(field, "TextFormat", 0)
+        gmsh.model.mesh.field.setString(field, "FileName", model["field"])
+        gmsh.model.mesh.field.setAsBackgroundMesh(field)
+
+
+def main(argv) :
+    import gmsh
+    model = pickle.load(sys.stdin.buffer)
+    output = argv[argv.index("-o") + 1]
+    gmsh.initialize(["gmsh"] + argv)
+    gmsh.option.setNumber("General.Terminal", 1)
+    buildModel(model)
+    gmsh.model.mesh.generate(2)
+    fmt = argv[argv.index("-format") + 1] if "-format" in argv else "msh4"
+    if fmt in ("msh2", "msh4") :
+        gmsh.option.setNumber("Mesh.MshFileVersion", 2.2 if fmt == "msh2" else 4.1)
+    # gmsh.write picks the format from the extension of the file name
+    ext = formatExtensions.get(fmt, ".msh")
+    if os.path.splitext(output)[1].lower() == ext :
+        gmsh.write(output)
+    else :
+        gmsh.write(output + ext)
+        os.replace(output + ext, output)
+    gmsh.finalize()
+
+
+if __name__ == "__main__" :
+    main(sys.argv[1:])
@@ -1,16 +1,232 @@
 # author  : Jonathan Lambrechts jonathan.lambrechts@uclouvain.be
 # licence : GPLv2 (see LICENSE.md)
 
-from PyQt5.QtCore import Qt,QSettings,QProcess,QProcessEnvironment
-from PyQt5.QtGui import QDoubleValidator
+from PyQt5.QtCore import Qt,QSettings,QProcess,QProcessEnvironment,QTimer
+from PyQt5.QtGui import QDoubleValidator, QIntValidator
 from PyQt5 import QtWidgets
-from qgis.core import QgsProject
+from qgis.core import QgsProject, QgsApplication, QgsTask
 import shlex
 import sys
 import os
+import pickle
+import re
+import hashlib
+import shutil
+import collections
+import json
+import time
+import platform
 
 from . import tools
 
+gmshCommand = "import gmsh; import sys; argv=['gmsh']+sys.argv[1:];gmsh.initialize(argv,run=True); gmsh.finalize();"
+
+# 2D meshing algorithms : label, -algo value, first gmsh version providing it
+algorithms = [
+    ("Automatic", "auto", (4, 6)),
+    ("Mesh Adapt", "meshadapt", (0,)),
+    ("Delaunay", "del2d", (0,)),
+    ("Frontal", "front2d", (0,)),
+    ("Frontal-Delaunay for quads", "delquad", (0,)),
+    ("BAMG", "bamg", (0,)),
+    ("Packing of parallelograms", "pack", (4, 0)),
+    ("Quasi-structured quads", "quadqs", (4, 9))
+]
+
+def gmshVersion() :
+    """Version tuple of the gmsh python module, None if it is not installed."""
+    try :
+        import gmsh
+    except Exception :
+        return None
+    version = getattr(gmsh, "__version__", None) or getattr(gmsh, "GMSH_API_VERSION", "0")
+    return tuple(int(i) for i in re.findall(r"\d+", version)[:3])
+
+
+def referencedFiles(geo) :
+    """Files read by a geometry file : field data files, merged and included
+    files."""
+    with open(geo, errors="replace") as f :
+        text = f.read()
+    names = re.findall(r'(?:FileName\s*=|Merge|Include)\s*"([^"]*)"', text)
+    return [os.path.join(os.path.dirname(geo), name) for name in names]
+
+
+def formatLogLine(txt) :
+    """Return the message and color of a line of the gmsh output."""
+    if txt.startswith("Error   : ") or txt.startswith("Fatal   : "):
+        return txt[10:], "red"
+    elif txt.startswith("Warning : ") :
+        return txt[10:], "orange"
+    elif txt.startswith("Info    : Running") :
+        return txt[10:], "black"
+    elif txt.startswith("Info    : ") :
+        return txt[10:], None
+    return txt, None
+
+
+class gmshTelemetry :
+    # parse the gmsh output into events : the start and end (with the wall
+    # and cpu times) of the reading, meshing, optimization and writing phases,
+    # their progress and the node and element counts
+
+    startRe = re.compile(r"^(Reading|Meshing [123]D|Optimizing mesh|Writing)\b.*\.\.\.\s*$")
+    doneRe = re.compile(r"^Done (reading|meshing [123]D|optimizing mesh|writing)\b.*?"
+        r"(?:\(Wall ([0-9.eE+-]+)s, CPU ([0-9.eE+-]+)s\)|\(([0-9.eE+-]+) ?s\))?\s*$")
+    progressRe = re.compile(r"^\[\s*(\d+)%\]")
+    countRe = re.compile(r"^(\d+) nodes (\d+) elements")
+    # part of the overall progress of each phase
+    phaseRange = {"reading" : (0, 5), "meshing 1D" : (5, 20), "meshing 2D" : (20, 90),
+        "meshing 3D" : (20, 90), "optimizing mesh" : (90, 95), "writing" : (95, 100)}
+
+    def __init__(self) :
+        self.phases = []
+        self.current = None
+        self.nodes = None
+        self.elements = None
+        self.progress = 0
+        self.start = time.time()
+
+    def parse(self, txt) :
+        """Update with an output line, return the overall progress (in
+        percent) if it changed, None otherwise."""
+        if not txt.startswith("Info    : ") :
+            return None
+        msg = txt[10:].strip()
+        progress = self.progress
+        step = self.progressRe.match(msg)
+        start = self.startRe.match(msg)
+        done = self.doneRe.match(msg)
+        count = self.countRe.match(msg)
+        if step and self.current in self.phaseRange :
+            a, b = self.phaseRange[self.current]
+            progress = a + (b - a) * int(step.group(1)) // 100
+        elif start :
+            phase = start.group(1)
+            self.current = phase[0].lower() + phase[1:]
+            self.phaseStart = time.time()
+            progress = self.phaseRange.get(self.current, (progress,))[0]
+        elif done :
+            phase = done.group(1)
+            wall = done.group(2) or done.group(4)
+            cpu = done.group(3)
+            if wall is None and phase == self.current :
+                wall = time.time() - self.phaseStart
+            self.phases.append({"phase" : phase, "wall" : float(wall) if wall is not None else None,
+                "cpu" : float(cpu) if cpu is not None else None})
+            self.current = None
+            progress = self.phaseRange.get(phase, (0, progress))[1]
+        elif count :
+            self.nodes, self.elements = int(count.group(1)), int(count.group(2))
+        progress = max(progress, self.progress)
+        if progress == self.progress :
+            return None
+        self.progress = progress
+        return progress
+
+    def summary(self, status, args) :
+        version = gmshVersion()
+        return {
+            "status" : status,
+            "arguments" : args,
+            "gmsh_version" : ".".join(str(i) for i in version) if version else None,
+            "host" : platform.node(),
+            "cpu_count" : os.cpu_count(),
+            "date" : time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.start)),
+            "wall" : time.time() - self.start,
+            "phases" : self.phases,
+            "nodes" : self.nodes,
+            "elements" : self.elements
+        }
+
+    def save(self, filename, status, args) :
+        """Write the summary as JSON in filename, return an error message if
+        it cannot be written."""
+        try :
+            with open(filename, "w") as f :
+                json.dump(self.summary(status, args), f, indent = 1)
+        except OSError as e :
+            return "cannot write the timing summary : %s" % e
+
+
+class logBuffer :
+    # append the log messages to a text widget in batches, on a timer, so that
+    # a verbose gmsh output does not slow down the GUI. Only the maxLines last
+    # lines are kept.
+
+    def __init__(self, textWidget, maxLines = 10000, interval = 200) :
+        self.textWidget = textWidget
+        textWidget.setMaximumBlockCount(maxLines)
+        self.lines = collections.deque(maxlen = maxLines)
+        self.timer = QTimer()
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.flush)
+
+    def log(self, msg, color = None) :
+        self.lines.append((msg, color))
+        if not self.timer.isActive() :
+            self.timer.start()
+
+    def clear(self) :
+        self.lines.clear()
+        self.textWidget.clear()
+
+    def flush(self) :
+        self.timer.stop()
+        scroll = self.textWidget.verticalScrollBar()
+        scrollToEnd = scroll.value() == scroll.maximum()
+        for msg, color in self.lines :
+            if color is not None :
+                self.textWidget.appendHtml("<b> <font color=%s>" % color + msg + "</b></font>")
+            else :
+                self.textWidget.appendHtml(msg)
+        self.lines.clear()
+        if scrollToEnd :
+            scroll.setValue(scroll.maximum())
+
+
+class outputReader :
+    # split the output of a process in lines, and stream it to a log file
+
+    def __init__(self, process, logFile = None) :
+        self.process = process
+        self.partial = b""
+        self.file = None
+        self.error = None
+        if logFile :
+            try :
+                self.file = open(logFile, "wb")
+            except OSError as e :
+                self.error = "cannot write the log file : %s" % e
+
+    def read(self) :
+        """Return the complete lines available."""
+        data = self.partial + self.process.readAllStandardOutput().data()
+        if self.file is not None :
+            self.file.write(data[len(self.partial):])
+        lines = data.split(b"\n")
+        self.partial = lines.pop()
+        return [str(line, "utf8", "replace") + "\n" for line in lines]
+
+    def close(self) :
+        """Return the last lines, with the incomplete one."""
+        lines = self.read()
+        if self.partial :
+            lines.append(str(self.partial, "utf8", "replace"))
+            self.partial = b""
+        if self.file is not None :
+            self.file.close()
+            self.file = None
+        return lines
+
+
+def gmshEnvironment() :
+    env = QProcessEnvironment.systemEnvironment()
+    env.remove("TERM")
+    return env
+
+
 class RunGmshDialog(QtWidgets.QDialog) :
 
     def __init__(self, mainWindow, loadMshDialog) :
@@ -20,6 +236,10 @@ class RunGmshDialog(QtWidgets.QDialog) :
         self.textWidget = QtWidgets.QPlainTextEdit()
         self.textWidget.setReadOnly(True)
         layout.addWidget(self.textWidget)
+        self.logBuffer = logBuffer(self.textWidget)
+        self.progressBar = QtWidgets.QProgressBar()
+        self.progressBar.setRange(0, 100)
+        layout.addWidget(self.progressBar)
         hlayout = QtWidgets.QHBoxLayout()
         layout.addLayout(hlayout)
         hlayout.addStretch(1)
@@ -42,36 +262,35 @@ class RunGmshDialog(QtWidgets.QDialog) :
         self.killed = True
 
     def onStdOut(self) :
-        while self.p.canReadLine() :
-            txt = str(self.p.readLine().data(),"utf8")
-            if txt.startswith("Error   : ") or txt.startswith("Fatal   : "):
-                self.log(txt[10:], "red")
-            elif txt.startswith("Warning : ") :
-                self.log(txt[10:], "orange")
-            elif txt.startswith("Info    : Running") :
-                self.log(txt[10:], "black")
-            elif txt.startswith("Info    : ") :
-                self.log(txt[10:])
-            else :
-                self.log(txt)
+        for txt in self.reader.read() :
+            self.outputLine(txt)
+
+    def outputLine(self, txt) :
+        self.log(*formatLogLine(txt))
+        progress = self.telemetry.parse(txt)
+        if progress is not None :
+            self.progressBar.setValue(progress)
 
     def log(self, msg, color = None):
-        scroll = self.textWidget.verticalScrollBar()
-        scrollToEnd = scroll.value() == scroll.maximum()
-        if color is not None :
-            self.textWidget.appendHtml("<b> <font color=%s>" % color + msg + "</b></font>")
-        else :
-            self.textWidget.appendHtml(msg)
-        if scrollToEnd :
-            scroll.setValue(scroll.maximum())
+        self.logBuffer.log(msg, color)
 
     def onFinished(self, state) :
+        for txt in self.reader.close() :
+            self.outputLine(txt)
+        if self.output :
+            status = "killed" if self.killed else "done" if state == 0 else "failed"
+            error = self.telemetry.save(self.output + ".timing.json", status, self.args[1:])
+            if error :
+                self.log(error, "orange")
         if not self.killed :
             if state != 0 :
                 self.log("An error occured.", "red")
             else :
+                self.progressBar.setValue(100)
                 self.log("Gmsh finished.", "green")
                 self.loadMshBtn.show()
+                if self.onSuccess is not None :
+                    self.onSuccess()
         self.closeBtn.show()
         self.closeBtn.setFocus()
         self.killBtn.hide()
@@ -80,19 +299,41 @@ class RunGmshDialog(QtWidgets.QDialog) :
         if self.killed :
             return
         if state == QProcess.FailedToStart :
+            self.reader.close()
             self.log("Cannot start gmsh executable : " + self.args[0], "red")
         elif state == QProcess.Crashed :
             self.log("Gmsh crashed.", "red")
         else :
             self.log("Unkown gmsh error.", "red")
 
-    def exec_(self, args) :
+    def showCached(self, output) :
+        self.logBuffer.clear()
+        self.progressBar.setValue(100)
+        self.log("Unchanged geometry and options, the cached mesh is copied to " + output, "green")
+        self.killBtn.hide()
+        self.loadMshBtn.show()
+        self.closeBtn.show()
+        self.closeBtn.setFocus()
+        self.show()
+        super(RunGmshDialog, self).exec_()
+
+    def exec_(self, args, stdin = None, onSuccess = None, output = None) :
+        # onSuccess is called when gmsh finishes without error, the whole
+        # output is written in output.log and the timing of the meshing
+        # phases in output.timing.json
+        self.onSuccess = onSuccess
+        self.output = output
+        self.telemetry = gmshTelemetry()
+        self.progressBar.setValue(0)
         self.p = QProcess()
         self.p.setProcessChannelMode(QProcess.MergedChannels)
         self.p.readyReadStandardOutput.connect(self.onStdOut)
         self.p.error.connect(self.onError)
         self.p.finished.connect(self.onFinished)
-        self.textWidget.clear()
+        self.logBuffer.clear()
+        self.reader = outputReader(self.p, output + ".log" if output else None)
+        if self.reader.error :
+            self.log(self.reader.error, "orange")
         self.args = args
         self.closeBtn.hide()
         self.loadMshBtn.hide()
@@ -100,13 +341,215 @@ class RunGmshDialog(QtWidgets.QDialog) :
         self.killBtn.show()
         self.killBtn.setFocus()
         self.show()
-        env = QProcessEnvironment.systemEnvironment()
-        env.remove("TERM")
-        self.p.setProcessEnvironment(env)
+        self.p.setProcessEnvironment(gmshEnvironment())
         self.p.start(args[0], args[1:])
+        if stdin is not None :
+            self.p.write(stdin)
+            self.p.closeWriteChannel()
         super(RunGmshDialog, self).exec_()
 
 
+class meshJob :
+    # one gmsh run of a batch, the last lines of its output are kept in log
+
+    def __init__(self, name, args, output) :
+        self.name = name
+        self.args = args
+        self.output = output
+        self.log = collections.deque(maxlen = 10000)
+        self.telemetry = gmshTelemetry()
+        self.state = "queued"
+        self.process = None
+
+    def finished(self) :
+        return self.state in ("done", "failed", "canceled")
+
+
+class BatchGmshDialog(QtWidgets.QDialog) :
+    # run a list of meshJob with at most workers concurrent gmsh processes
+
+    def __init__(self, mainWindow) :
+        super(BatchGmshDialog, self).__init__(mainWindow)
+        self.setWindowTitle("Running Gmsh jobs")
+        layout = QtWidgets.QVBoxLayout()
+        self.jobTable = QtWidgets.QTableWidget(0, 3)
+        self.jobTable.setHorizontalHeaderLabels(["Job", "Status", ""])
+        self.jobTable.horizontalHeader().setSectionResizeMode(0, QtWidgets.QHeaderView.Stretch)
+        self.jobTable.setSelectionBehavior(QtWidgets.QAbstractItemView.SelectRows)
+        self.jobTable.setSelectionMode(QtWidgets.QAbstractItemView.SingleSelection)
+        self.jobTable.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.jobTable.currentCellChanged.connect(self.showLog)
+        layout.addWidget(self.jobTable)
+        self.progressBar = QtWidgets.QProgressBar()
+        layout.addWidget(self.progressBar)
+        self.textWidget = QtWidgets.QPlainTextEdit()
+        self.textWidget.setReadOnly(True)
+        layout.addWidget(self.textWidget)
+        self.logBuffer = logBuffer(self.textWidget)
+        hlayout = QtWidgets.QHBoxLayout()
+        layout.addLayout(hlayout)
+        hlayout.addStretch(1)
+        self.cancelAllBtn = QtWidgets.QPushButton("Cancel all")
+        self.cancelAllBtn.clicked.connect(self.cancelAll)
+        hlayout.addWidget(self.cancelAllBtn)
+        closeBtn = QtWidgets.QPushButton("Close")
+        closeBtn.clicked.connect(self.close)
+        hlayout.addWidget(closeBtn)
+        self.resize(700, 700)
+        self.setLayout(layout)
+        self.jobs = []
+
+    def run(self, jobs, workers) :
+        # the jobs of a previous batch are not run concurrently
+        self.cancelAll()
+        self.jobs = jobs
+        self.workers = workers
+        self.jobTable.setRowCount(len(jobs))
+        for i, job in enumerate(jobs) :
+            self.jobTable.setItem(i, 0, QtWidgets.QTableWidgetItem(job.name))
+            self.jobTable.setItem(i, 1, QtWidgets.QTableWidgetItem(job.state))
+            cancelBtn = QtWidgets.QPushButton("Cancel")
+            cancelBtn.clicked.connect(lambda checked, job=job : self.cancelJob(job))
+            self.jobTable.setCellWidget(i, 2, cancelBtn)
+        self.progressBar.setRange(0, 100 * len(jobs))
+        self.logBuffer.clear()
+        self.cancelAllBtn.setEnabled(True)
+        self.show()
+        self.jobTable.selectRow(0)
+        self.startJobs()
+
+    def startJobs(self) :
+        running = sum(job.state == "running" for job in self.jobs)
+        for job in self.jobs :
+            if running >= self.workers :
+                break
+            if job.state == "queued" :
+                self.startJob(job)
+                running += 1
+        done = sum(job.finished() for job in self.jobs)
+        self.updateProgress()
+        self.cancelAllBtn.setEnabled(done != len(self.jobs))
+
+    def updateProgress(self) :
+        self.progressBar.setValue(sum(100 if job.finished() else job.telemetry.progress for job in self.jobs))
+
+    def startJob(self, job) :
+        p = QProcess(self)
+        p.setProcessChannelMode(QProcess.MergedChannels)
+        p.readyReadStandardOutput.connect(lambda : self.onStdOut(job))
+        p.error.connect(lambda state : self.onError(job, state))
+        p.finished.connect(lambda state : self.onFinished(job, state))
+        p.setProcessEnvironment(gmshEnvironment())
+        job.process = p
+        job.reader = outputReader(p, job.output + ".log")
+        if job.reader.error :
+            self.jobLog(job, "Warning : " + job.reader.error + "\n")
+        self.setState(job, "running")
+        p.start(job.args[0], job.args[1:])
+
+    def setState(self, job, state) :
+        job.state = state
+        if job not in self.jobs :
+            return
+        row = self.jobs.index(job)
+        self.jobTable.item(row, 1).setText(state)
+        self.jobTable.cellWidget(row, 2).setEnabled(not job.finished())
+
+    def currentJob(self) :
+        row = self.jobTable.currentRow()
+        return self.jobs[row] if 0 <= row < len(self.jobs) else None
+
+    def showLog(self, row) :
+        self.logBuffer.clear()
+        job = self.currentJob()
+        if job is not None :
+            for txt in job.log :
+                self.logBuffer.log(*formatLogLine(txt))
+
+    def jobLog(self, job, txt) :
+        job.log.append(txt)
+        if job is self.currentJob() :
+            self.logBuffer.log(*formatLogLine(txt))
+
+    def onStdOut(self, job) :
+        for txt in job.reader.read() :
+            self.outputLine(job, txt)
+
+    def outputLine(self, job, txt) :
+        self.jobLog(job, txt)
+        progress = job.telemetry.parse(txt)
+        if progress is not None and job in self.jobs :
+            self.jobTable.item(self.jobs.index(job), 1).setText("%s %d%%" % (job.state, progress))
+            self.updateProgress()
+
+    def onError(self, job, state) :
+        if state != QProcess.FailedToStart or job.finished() :
+            return
+        # finished is not emitted
+        job.reader.close()
+        self.jobLog(job, "Error   : cannot start " + job.args[0] + "\n")
+        self.setState(job, "failed")
+        self.startJobs()
+
+    def onFinished(self, job, state) :
+        for txt in job.reader.close() :
+            self.outputLine(job, txt)
+        if job.state == "running" :
+            self.jobLog(job, "Gmsh finished.\n" if state == 0 else "Error   : gmsh failed.\n")
+            self.setState(job, "done" if state == 0 else "failed")
+        error = job.telemetry.save(job.output + ".timing.json", job.state, job.args[1:])
+        if error :
+            self.jobLog(job, "Warning : " + error + "\n")
+        self.startJobs()
+
+    def cancelJob(self, job) :
+        if job.state == "queued" :
+            self.setState(job, "canceled")
+            self.startJobs()
+        elif job.state == "running" :
+            self.jobLog(job, "Warning : killed\n")
+            self.setState(job, "canceled")
+            job.process.kill()
+
+    def cancelAll(self) :
+        # cancel the queued jobs first, so that none of them is started
+        for job in sorted(self.jobs, key = lambda job : job.state == "running") :
+            self.cancelJob(job)
+
+
+class MeshKeyTask(QgsTask) :
+    # hash the inputs of a mesh in a background thread, they can be large
+    # (the mesh size field in particular). onFinished(task, status) is
+    # called from the main thread with the digests in task.digests.
+
+    def __init__(self, stdin, geo, inputs, onFinished) :
+        super(MeshKeyTask, self).__init__("Look up the Gmsh mesh cache", QgsTask.CanCancel)
+        self.stdin = stdin
+        self.geo = geo
+        self.inputs = inputs
+        self.onFinished = onFinished
+        self.digests = None
+
+    def run(self) :
+        try :
+            inputs = list(self.inputs)
+            if self.geo is not None and os.path.isfile(self.geo) :
+                inputs += [self.geo] + referencedFiles(self.geo)
+            digests = [hashlib.sha256(self.stdin).hexdigest() if self.stdin is not None else None]
+            for f in inputs :
+                if self.isCanceled() :
+                    return False
+                digests.append(tools.fileDigest(f) if os.path.isfile(f) else None)
+            self.digests = digests
+            return True
+        except Exception :
+            # the mesh is then generated without the cache
+            return False
+
+    def finished(self, result) :
+        self.onFinished(self, result)
+
+
 class MeshDialog(QtWidgets.QDialog) :
 
     def __init__(self, mainWindow, iface, loadMshDialog) :
@@ -121,10 +564,11 @@ class MeshDialog(QtWidgets.QDialog) :
         self.inputGeo.fileWidget.textChanged.connect(self.validate)
         self.outputMsh.fileWidget.textChanged.connect(self.validate)
         self.algoSelector = QtWidgets.QComboBox(self)
-        self.algoSelector.addItem("Mesh Adapt", "meshadapt")
-        self.algoSelector.addItem("Delaunay", "del2d")
-        self.algoSelector.addItem("Frontal", "front2d")
         tools.TitleLayout("Meshing algorithm", self.algoSelector, layout)
+        self.threads = QtWidgets.QSpinBox()
+        self.threads.setRange(0, 1024)
+        self.threads.setSpecialValueText("Automatic (%d cores)" % (os.cpu_count() or 1))
+        tools.TitleLayout("Number of threads", self.threads, layout)
         self.formatSelector = QtWidgets.QComboBox(self)
         self.formatSelector.addItem(".msh version 2", "msh2")
         self.formatSelector.addItem(".msh version 4", "msh4")
@@ -139,13 +583,34 @@ class MeshDialog(QtWidgets.QDialog) :
         tools.TitleLayout("1D mesh size integration precision", self.epslc1d, layout)
         self.commandLine = QtWidgets.QLineEdit()
         tools.TitleLayout("Additional command line arguments", self.commandLine, layout)
+        self.batchJobs = QtWidgets.QPlainTextEdit()
+        self.batchJobs.setPlaceholderText("one job per line : a geometry file followed by additional arguments,\n"
+            "e.g. model.geo -clscale 0.5")
+        self.batchJobs.setMaximumHeight(100)
+        self.batchJobs.textChanged.connect(self.validate)
+        tools.TitleLayout("Batch jobs", self.batchJobs, layout)
+        self.batchWorkers = QtWidgets.QSpinBox()
+        self.batchWorkers.setRange(1, max(os.cpu_count() or 1, 1))
+        tools.TitleLayout("Concurrent batch jobs", self.batchWorkers, layout)
+        self.cacheSize = QtWidgets.QLineEdit()
+        validator = QIntValidator()
+        validator.setBottom(0)
+        self.cacheSize.setValidator(validator)
+        tools.TitleLayout("Mesh cache size in MB (0 to disable)", self.cacheSize, layout)
         self.runLayout = tools.CancelRunLayout(self,"Mesh", self.mesh, layout)
         self.runLayout.runButton.setEnabled(False)
+        self.batchButton = QtWidgets.QPushButton("Run batch jobs")
+        self.batchButton.clicked.connect(self.runBatch)
+        self.batchButton.setEnabled(False)
+        self.runLayout.insertWidget(2, self.batchButton, 0)
         self.setLayout(layout)
         self.setMaximumHeight(self.height())
         self.runGmshDialog = RunGmshDialog(iface.mainWindow(), loadMshDialog)
+        self.batchDialog = BatchGmshDialog(iface.mainWindow())
         self.resize(max(400, self.width()), self.height())
         self.mainWindow = mainWindow
+        self.model = None
+        self.tasks = set()
 
     def onInputFileChange(self, text) :
         if (self.outputMsh.getFile() == "" or self.autoMshName) and text.endswith(".geo") :
@@ -156,9 +621,12 @@ class MeshDialog(QtWidgets.QDialog) :
         outputMsh = self.outputMsh.getFile()
         self.autoMshName = inputGeo.endswith(".geo") and (outputMsh == inputGeo[:-4] + ".msh" or outputMsh == "")
         self.runLayout.runButton.setEnabled(True)
+        self.batchButton.setEnabled(self.model is None and bool(self.batchJobs.toPlainText().strip()))
 
-    def mesh(self) :
-        self.close()
+    def meshOptions(self) :
+        """Save the options in the project and return the gmsh arguments
+        (without the thread count) and the mesh format, None if gmsh is not
+        installed."""
         algo = self.algoSelector.itemData(self.algoSelector.currentIndex())
         fmt = self.formatSelector.itemData(self.formatSelector.currentIndex())
         proj = QgsProject.instance()
@@ -167,27 +635,135 @@ class MeshDialog(QtWidgets.QDialog) :
         proj.writeEntry("gmsh", "algorithm", self.algoSelector.currentText())
         proj.writeEntry("gmsh", "msh_format", fmt)
         proj.writeEntry("gmsh", "epslc1d", self.epslc1d.text())
+        proj.writeEntry("gmsh", "threads", self.threads.value())
         proj.writeEntry("gmsh", "extraargs", self.commandLine.text())
         proj.writeEntry("gmsh", "auto_msh_name", self.autoMshName)
+        proj.writeEntry("gmsh", "batch_jobs", self.batchJobs.toPlainText())
+        proj.writeEntry("gmsh", "batch_workers", self.batchWorkers.value())
+        proj.writeEntry("gmsh", "mesh_cache_size", self.cacheSize.text() or "0")
         if not tools.install_gmsh_if_needed(self.mainWindow):
+            return None
+        options = ["-algo", algo, "-format",fmt,
+            "-epslc1d", self.epslc1d.text()] + shlex.split(self.commandLine.text())
+        return options, fmt
+
+    def runBatch(self) :
+        self.close()
+        meshOptions = self.meshOptions()
+        if meshOptions is None :
+            return
+        options, fmt = meshOptions
+        # batch jobs share the cores, unless the thread count is given
+        threads = self.threads.value()
+        jobs = self.parseBatchJobs(options + (["-nt", str(threads)] if threads else []), fmt)
+        if jobs :
+            self.batchDialog.run(jobs, self.batchWorkers.value())
+
+    def mesh(self) :
+        self.close()
+        meshOptions = self.meshOptions()
+        if meshOptions is None :
+            return
+        options = ["-nt", str(self.threads.value() or os.cpu_count() or 1)] + meshOptions[0]
+        output = self.outputMsh.getFile()
+        stdin = None
+        geo = None
+        inputs = []
+        if self.model is not None :
+            stdin = pickle.dumps(self.model)
+            script = os.path.join(os.path.dirname(__file__), "meshModel.py")
+            command = [sys.executable, script]
+            inputs = [self.model["field"]] if self.model["field"] else []
+        else :
+            geo = self.inputGeo.getFile()
+            command = [sys.executable, "-c", gmshCommand, "-2", geo]
+        args = command + ["-o", output] + options
+        cache = tools.projectCache("mesh_cache_size", "meshes")
+        if cache is None :
+            self.runGmshDialog.exec_(args, stdin, None, output)
             return
-        args = [sys.executable, "-c","import gmsh; import sys; argv=['gmsh']+sys.argv[1:];gmsh.initialize(argv,run=True); gmsh.finalize();", "-2", self.inputGeo.getFile(),
-            "-algo", algo, "-format",fmt,
-            "-epslc1d", self.epslc1d.text(), "-o", self.outputMsh.getFile()] + shlex.split(self.commandLine.text())
-        self.runGmshDialog.exec_(args)
+
+        def onHashed(task, status) :
+            self.tasks.discard(task)
+            onSuccess = None
+            if status :
+                key = cache.key("mesh", task.digests, gmshVersion(), options)
+                ext = os.path.splitext(output)[1]
+                cached = cache.get(key, ext)
+                if cached is not None :
+                    shutil.copyfile(cached, output)
+                    self.runGmshDialog.showCached(output)
+                    return
+                def onSuccess() :
+                    tmp = cache.tmpFile(ext)
+                    shutil.copyfile(output, tmp)
+                    cache.put(key, ext, tmp)
+            self.runGmshDialog.exec_(args, stdin, onSuccess, output)
+
+        # keep a reference, the task is deleted with its python object
+        task = MeshKeyTask(stdin, geo, inputs, onHashed)
+        self.tasks.add(task)
+        QgsApplication.taskManager().addTask(task)
+
+    def parseBatchJobs(self, options, fmt) :
+        """Return the meshJob list described by the batch jobs text. The mesh
+        files are named after the geometry files (with the job number if a
+        geometry file is used several times). The cores are split between the
+        concurrent jobs, unless a job sets its thread count."""
+        lines = []
+        for line in self.batchJobs.toPlainText().splitlines() :
+            words = shlex.split(line, comments=True)
+            if words :
+                lines.append((words[0], words[1:]))
+        if not lines :
+            return []
+        ext = {"stl" : ".stl", "cgns" : ".cgns"}.get(fmt, ".msh")
+        nt = max(1, (os.cpu_count() or 1) // min(self.batchWorkers.value(), len(lines)))
+        geos = [geo for geo, _ in lines]
+        jobs = []
+        for i, (geo, extra) in enumerate(lines) :
+            output = os.path.splitext(geo)[0]
+            if geos.count(geo) > 1 :
+                output += "_%d" % (i + 1)
+            output += ext
+            threads = [] if "-nt" in options + extra else ["-nt", str(nt)]
+            args = [sys.executable, "-c", gmshCommand, "-2", geo, "-o", output] + threads + options + extra
+            jobs.append(meshJob(" ".join([os.path.basename(geo)] + extra), args, output))
+        return jobs
 
     def exec_(self) :
+        self.execModel(None)
+
+    def fillAlgorithms(self) :
+        # only the algorithms of the installed gmsh (all if it is not installed yet)
+        version = gmshVersion()
+        self.algoSelector.clear()
+        for label, name, since in algorithms :
+            if version is None or version >= since :
+                self.algoSelector.addItem(label, name)
+
+    def execModel(self, model) :
+        # model is a geometry exported in memory by exportGeometry.modelWriter,
+        # the input geometry file is then only used to name the mesh file
+        self.model = model
+        self.inputGeo.fileWidget.setEnabled(model is None)
+        self.batchJobs.setEnabled(model is None)
         proj = QgsProject.instance()
         self.outputMsh.setFile(proj.readEntry("gmsh", "msh_file", "")[0])
         self.inputGeo.setFile(proj.readEntry("gmsh", "geo_file", "")[0])
+        self.fillAlgorithms()
         idx = self.algoSelector.findText(proj.readEntry("gmsh", "algorithm", "Frontal")[0])
-        self.algoSelector.setCurrentIndex(idx)
+        self.algoSelector.setCurrentIndex(idx if idx >= 0 else self.algoSelector.findData("front2d"))
+        self.threads.setValue(proj.readNumEntry("gmsh", "threads", 0)[0])
         idx = self.formatSelector.findData(proj.readEntry("gmsh", "msh_format", "msh4")[0])
         self.formatSelector.setCurrentIndex(idx)
         self.epslc1d.setText(proj.readEntry("gmsh", "epslc1d", "1e-3")[0])
         self.commandLine.setText(proj.readEntry("gmsh", "extraargs", "")[0])
         self.runLayout.setFocus()
         self.autoMshName = proj.readBoolEntry("gmsh", "auto_msh_name", True)[0]
+        self.batchJobs.setPlainText(proj.readEntry("gmsh", "batch_jobs", "")[0])
+        self.cacheSize.setText(proj.readEntry("gmsh", "mesh_cache_size", "1024")[0])
+        self.batchWorkers.setValue(proj.readNumEntry("gmsh", "batch_workers", min(4, self.batchWorkers.maximum()))[0])
         self.validate()
         super(MeshDialog, self).exec_()
 
@@ -14,6 +14,9 @@ import urllib.request
 from zipfile import ZipFile
 import re
 import io
+import hashlib
+import tempfile
+import threading
 
 if sys.platform == "win32":
     windows_install_path = os.path.dirname(__file__)+'/gmsh_install' 
@@ -212,3 +215,111 @@ class CancelRunLayout(QtWidgets.QHBoxLayout) :
     def setFocus(self) :
         self.runButton.setFocus()
 
+
+
+def fileDigest(filename, blockSize=1<<20) :
+    """sha256 hex digest of the content of a file"""
+    h = hashlib.sha256()
+    with open(filename, "rb") as f :
+        for block in iter(lambda : f.read(blockSize), b"") :
+            h.update(block)
+    return h.hexdigest()
+
+
+class FileCache :
+    """A directory of files addressed by a key. The least recently used files
+    are removed when the total size exceeds maxSize bytes."""
+
+    def __init__(self, path, maxSize) :
+        self.path = path
+        self.maxSize = maxSize
+
+    @staticmethod
+    def key(*parts) :
+        return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+    def get(self, key, ext) :
+        """Return the cached file of key or None, and mark it as used."""
+        filename = os.path.join(self.path, key + ext)
+        if not os.path.isfile(filename) :
+            return None
+        os.utime(filename)
+        return filename
+
+    def tmpFile(self, ext) :
+        """Return a new file name in the cache directory, to be filled then
+        given to put."""
+        os.makedirs(self.path, exist_ok=True)
+        fd, filename = tempfile.mkstemp(ext, "tmp_", self.path)
+        os.close(fd)
+        return filename
+
+    def put(self, key, ext, filename) :
+        """Move filename into the cache as the file of key and return its new
+        path."""
+        os.makedirs(self.path, exist_ok=True)
+        target = os.path.join(self.path, key + ext)
+        os.replace(filename, target)
+        self.evict(target)
+        return target
+
+    def evict(self, keep=None) :
+        files = []
+        for name in os.listdir(self.path) :
+            filename = os.path.join(self.path, name)
+            if name.startswith("tmp_") or not os.path.isfile(filename) :
+                continue
+            st = os.stat(filename)
+            files.append((st.st_mtime, st.st_size, filename))
+        total = sum(size for _, size, _ in files)
+        for _, size, filename in sorted(files) :
+            if total <= self.maxSize :
+                break
+            if filename == keep :
+                continue
+            try :
+                os.remove(filename)
+                total -= size
+            except OSError :
+                # still opened (e.g. by a layer on windows)
+                pass
+
+
+def projectCache(entry, *subdirs) :
+    """FileCache in the .gmsh_cache directory of the project (or of the QGIS
+    settings for an unsaved project), limited to the size in MB read in the
+    project entry. Return None if the cache is disabled."""
+    proj = QgsProject.instance()
+    maxSize = int(proj.readEntry("gmsh", entry, "1024")[0] or 0)
+    if maxSize <= 0 :
+        return None
+    home = proj.homePath() or QgsApplication.qgisSettingsDirPath()
+    return FileCache(os.path.join(home, ".gmsh_cache", *subdirs), maxSize << 20)
+
+
+class taskProgress :
+    # report the progress of a loop on a part [start, end] of the progress
+    # bar of a task, only when the displayed percentage changes
+
+    def __init__(self, task, start = 0, end = 100) :
+        self.task = task
+        self.start = start
+        self.end = end
+        self.lock = threading.Lock()
+        self.setTotal(1)
+
+    def setTotal(self, total) :
+        self.total = max(total, 1)
+        self.count = 0
+        self.percent = None
+
+    def advance(self, n = 1) :
+        """Return False if the task is canceled, can be called from several
+        threads."""
+        with self.lock :
+            self.count += n
+            percent = int(self.start + (self.end - self.start) * min(self.count, self.total) / self.total)
+            if percent != self.percent :
+                self.percent = percent
+                self.task.setProgress(percent)
+        return not self.task.isCanceled()